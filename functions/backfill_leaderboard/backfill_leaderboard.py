@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Rebuilds the place counts served by get_leaderboard from a parallel
+segmented scan of ItemTable.
+
+Meant to be invoked by hand, when the leaderboard is first deployed or if the
+counts kept by item_stream have drifted. Writes made while the backfill runs
+may be counted twice or missed, so run it when the app is quiet.
+"""
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+if ('AWS_DEFAULT_REGION' in os.environ
+    and os.environ['AWS_DEFAULT_REGION'] != 'LOCAL'):
+    region = os.environ['AWS_DEFAULT_REGION']
+    logger.info("Using DynamoDB instance in {} region".format(region))
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              region_name=region)
+else:
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              endpoint_url='http://localhost:8000')
+    logger.info("Using local DynamoDB instance")
+
+table = dynamodb.Table(os.environ['itemsTableName'])
+count_table = dynamodb.Table(os.environ['categoryCountsTableName'])
+# Each scan segment runs on its own thread. They share the client rather
+# than a Table resource, and still get plain Python types back.
+client = dynamodb.meta.client
+
+DEFAULT_SEGMENTS = int(os.environ.get('scanSegments', 8))
+
+
+def parallel_scan(table_name, segments):
+    """Scans table_name with one thread per segment, returning a Counter of
+    (category_name, place_name) pairs"""
+    def scan_segment(segment):
+        scan_args = {
+            'TableName': table_name,
+            'ProjectionExpression': 'category_name, place_name',
+            'Segment': segment,
+            'TotalSegments': segments
+        }
+        counts = Counter()
+        while True:
+            response = client.scan(**scan_args)
+            counts.update((item['category_name'], item['place_name'])
+                          for item in response['Items']
+                          if 'place_name' in item)
+            if 'LastEvaluatedKey' not in response:
+                return counts
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    counts = Counter()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for segment_counts in executor.map(scan_segment, range(segments)):
+            counts.update(segment_counts)
+    return counts
+
+
+def lambda_handler(event, context):
+    segments = int((event or {}).get('segments') or DEFAULT_SEGMENTS)
+    logger.info("Counting places in {} with {} segments".format(table.name,
+                                                               segments))
+    counts = parallel_scan(table.name, segments)
+    # Anything counted before but no longer saved by anyone
+    stale_keys = set(parallel_scan(count_table.name, segments)) - set(counts)
+
+    with count_table.batch_writer() as batch:
+        for (category_name, place_name), save_count in counts.items():
+            batch.put_item(Item={'category_name': category_name,
+                                 'place_name': place_name,
+                                 'save_count': save_count})
+        for category_name, place_name in stale_keys:
+            batch.delete_item(Key={'category_name': category_name,
+                                   'place_name': place_name})
+    logger.info("Wrote {} place counts and removed {} stale counts".format(
+        len(counts), len(stale_keys)))
+    return {'Places': len(counts), 'Removed': len(stale_keys)}
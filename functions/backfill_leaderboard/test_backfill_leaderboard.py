@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+from backfill_leaderboard import *
+
+
+def get_count(category_name, place_name):
+    response = count_table.get_item(Key={'category_name': category_name,
+                                         'place_name': place_name})
+    return response.get('Item', {}).get('save_count')
+
+
+def test_lambda_handler():
+    count_table.put_item(Item={'category_name': 'backfilltest',
+                               'place_name': 'closed down',
+                               'save_count': 3})
+    lambda_handler({'segments': 2}, None)
+    assert get_count('bbq', 'central bbq') == 2
+    assert get_count('bbq', 'AJs') == 1
+    assert get_count('pizza', 'aldos') == 1
+    assert get_count('backfilltest', 'closed down') is None
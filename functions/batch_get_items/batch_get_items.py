@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Looks up items for many (user_id, category_name) keys or many users in a
+single request, saving clients from calling GET /items once per list.
+
+The response is kept within Lambda's 6MB limit by returning at most
+MAX_USER_ITEMS items per user and MAX_RESPONSE_BYTES of items in all.
+Truncated is true if any items were left out.
+"""
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+if ('AWS_DEFAULT_REGION' in os.environ
+    and os.environ['AWS_DEFAULT_REGION'] != 'LOCAL'):
+    region = os.environ['AWS_DEFAULT_REGION']
+    logger.info("Using DynamoDB instance in {} region".format(region))
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              region_name=region)
+else:
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              endpoint_url='http://localhost:8000')
+    logger.info("Using local DynamoDB instance")
+
+table = dynamodb.Table(os.environ['itemsTableName'])
+# Resources aren't thread safe, but their underlying client is and still
+# takes care of converting to and from DynamoDB types.
+client = dynamodb.meta.client
+
+ITEM_ATTRIBUTES = ['user_id', 'category_name', 'place_name']
+# BatchGetItem takes at most 100 keys per call
+BATCH_GET_SIZE = 100
+MAX_KEYS = 1000
+MAX_USER_IDS = 100
+MAX_USER_ITEMS = 1000
+# Items as JSON, leaves room under the 6MB limit for the rest of the response
+MAX_RESPONSE_BYTES = 5 * 1024 * 1024
+MAX_RETRIES = 6
+MAX_WORKERS = int(os.environ.get('batchWorkers', 8))
+
+
+def backoff(attempt):
+    """Sleeps for an exponentially growing, jittered, amount of time"""
+    time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 2)))
+
+
+def batch_get(keys):
+    """Gets up to BATCH_GET_SIZE keys, retrying any unprocessed keys"""
+    request_items = {
+        table.name: {'Keys': keys,
+                     'ProjectionExpression': ', '.join(ITEM_ATTRIBUTES)}
+    }
+    items = []
+    for attempt in range(MAX_RETRIES + 1):
+        response = client.batch_get_item(RequestItems=request_items)
+        items.extend(response['Responses'].get(table.name, []))
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            return items
+        logger.info("Retrying {} unprocessed keys".format(
+            len(request_items[table.name]['Keys'])))
+        backoff(attempt)
+    raise RuntimeError("Unable to get {} keys after {} retries".format(
+        len(request_items[table.name]['Keys']), MAX_RETRIES))
+
+
+def query_user(user_id, max_items=MAX_USER_ITEMS):
+    """Gets up to max_items of a user's items, following LastEvaluatedKey.
+    Returns the items and whether the user has more."""
+    query_args = {
+        'TableName': table.name,
+        'KeyConditionExpression': Key('user_id').eq(user_id),
+        'ProjectionExpression': ', '.join(ITEM_ATTRIBUTES)
+    }
+    items = []
+    while True:
+        # One more than is returned, to tell if there are more
+        query_args['Limit'] = max_items + 1 - len(items)
+        response = client.query(**query_args)
+        items.extend(response['Items'])
+        if len(items) > max_items:
+            logger.info("Only returning {} items of user {}".format(
+                max_items, user_id))
+            return items[:max_items], True
+        if 'LastEvaluatedKey' not in response:
+            return items, False
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_keys(data):
+    """Returns the de-duplicated list of keys requested.
+
+    BatchGetItem rejects requests with duplicate keys, so they are dropped
+    here rather than failing the whole request."""
+    keys = []
+    seen = set()
+    for key in data.get('keys') or []:
+        try:
+            key_tuple = (str(key['user_id']), str(key['category_name']))
+        except (KeyError, TypeError):
+            raise ValueError(
+                "Bad Request: keys need a user_id and category_name")
+        if key_tuple not in seen:
+            seen.add(key_tuple)
+            keys.append({'user_id': key_tuple[0],
+                         'category_name': key_tuple[1]})
+    if len(keys) > MAX_KEYS:
+        raise ValueError(
+            "Bad Request: at most {} keys per request".format(MAX_KEYS))
+    return keys
+
+
+def get_user_ids(data):
+    """Returns the de-duplicated list of user ids requested"""
+    user_ids = sorted({str(user_id) for user_id in data.get('user_ids') or []})
+    if len(user_ids) > MAX_USER_IDS:
+        raise ValueError("Bad Request: at most {} user_ids per request".format(
+            MAX_USER_IDS))
+    return user_ids
+
+
+def lambda_handler(event, context):
+    api_request_id = event['metadata']['requestId']
+    user_id = event['metadata']['userId']
+    data = event.get('data') or {}
+    if type(data) is not dict:
+        raise ValueError("Bad Request: body must be a JSON object")
+    keys = get_keys(data)
+    user_ids = get_user_ids(data)
+    logger.info(
+        "Handling API request {} for user {} with {} keys and {} "
+        "user_ids".format(api_request_id, user_id, len(keys), len(user_ids)))
+
+    key_chunks = [keys[i:i + BATCH_GET_SIZE]
+                  for i in range(0, len(keys), BATCH_GET_SIZE)]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Everything is submitted before waiting on anything, so the key
+        # lookups and user queries run alongside each other
+        key_futures = [executor.submit(batch_get, key_chunk)
+                       for key_chunk in key_chunks]
+        user_futures = [executor.submit(query_user, user_id)
+                        for user_id in user_ids]
+        results = [future.result() for future in key_futures]
+        truncated = False
+        for future in user_futures:
+            user_items, user_truncated = future.result()
+            results.append(user_items)
+            truncated = truncated or user_truncated
+    # The same item may be requested by key and by user_id
+    merged = {}
+    for result in results:
+        for item in result:
+            merged[(item['user_id'], item['category_name'])] = item
+    items = []
+    size = 0
+    for key in sorted(merged):
+        size += len(json.dumps(merged[key]))
+        if size > MAX_RESPONSE_BYTES:
+            logger.info("Only returning {} of {} items".format(
+                len(items), len(merged)))
+            truncated = True
+            break
+        items.append(merged[key])
+    return {'Items': items, 'Count': len(items), 'Truncated': truncated}
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import pytest
+
+from batch_get_items import *
+
+
+def test_lambda_handler_keys():
+    event = {'metadata': {'userId': 'jjk3',
+                          'requestId': __name__},
+             'data': {'keys': [
+                 {'user_id': 'jjk3', 'category_name': 'bbq'},
+                 {'user_id': 'jdebari', 'category_name': 'bbq'},
+                 {'user_id': 'jdebari', 'category_name': 'bbq'},
+                 {'user_id': 'nobody', 'category_name': 'bbq'}
+             ]}}
+    expected_items = [{'user_id': 'jdebari',
+                       'category_name': 'bbq',
+                       'place_name': 'AJs'},
+                      {'user_id': 'jjk3',
+                       'category_name': 'bbq',
+                       'place_name': 'central bbq'}]
+    response = lambda_handler(event, None)
+    assert response['Items'] == expected_items
+    assert response['Count'] == 2
+    assert not response['Truncated']
+
+
+def test_lambda_handler_user_ids():
+    event = {'metadata': {'userId': 'jjk3',
+                          'requestId': __name__},
+             'data': {'user_ids': ['pager', 'jjk3'],
+                      'keys': [{'user_id': 'jjk3', 'category_name': 'bbq'}]}}
+    response = lambda_handler(event, None)
+    assert [(item['user_id'], item['category_name'])
+            for item in response['Items']] == [('jjk3', 'bbq'),
+                                               ('pager', 'bbq'),
+                                               ('pager', 'pizza'),
+                                               ('pager', 'tacos')]
+
+
+def test_query_user_max_items():
+    items, truncated = query_user('pager', max_items=2)
+    assert len(items) == 2
+    assert truncated
+    items, truncated = query_user('pager', max_items=3)
+    assert len(items) == 3
+    assert not truncated
+
+
+def test_lambda_handler_too_many_keys():
+    keys = [{'user_id': 'jjk3', 'category_name': str(i)}
+            for i in range(MAX_KEYS + 1)]
+    event = {'metadata': {'userId': 'jjk3',
+                          'requestId': __name__},
+             'data': {'keys': keys}}
+    with pytest.raises(ValueError):
+        lambda_handler(event, None)
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
+import base64
+import json
 import logging
 import os
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from hashlib import sha1
 
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -20,15 +27,284 @@ else:
     logger.info("Using local DynamoDB instance")
 
 table = dynamodb.Table(os.environ['itemsTableName'])
+version_table = dynamodb.Table(os.environ['itemVersionsTableName'])
+
+# Only the attributes shown by the app are read from the table
+ITEM_ATTRIBUTES = ['user_id', 'category_name', 'place_name']
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+# Params that change the response, anything else is ignored
+QUERY_PARAMS = ['category', 'category_prefix', 'category_from', 'category_to',
+                'order', 'limit', 'cursor', 'fields']
+
+
+class NotModified(Exception):
+    """Raised when the client already has the current version of the
+    response, API GW maps it to a 304."""
+
+
+class ItemCache:
+    """LRU cache of encoded response bodies bounded by their size in
+    bytes. Entries are served straight from memory until their TTL runs out,
+    after that they are only reused if the user's item version, which is
+    bumped by the item_stream function on every write, hasn't changed.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= entry['size']
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value, version):
+        self.evict(key)
+        size = len(value)
+        if size > self.max_bytes:
+            logger.info("Response of {} bytes too large to cache".format(size))
+            return
+        self._entries[key] = {
+            'expires': time.time() + self.ttl,
+            'size': size,
+            'value': value,
+            'version': version
+        }
+        self._size += size
+        while self._size > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self.evict(oldest_key)
+
+    def refresh(self, key):
+        self._entries[key]['expires'] = time.time() + self.ttl
+
+    @property
+    def size(self):
+        return self._size
+
+
+# Lives for as long as the container is warm
+cache = ItemCache(int(os.environ.get('cacheMaxBytes', 8 * 1024 * 1024)),
+                  int(os.environ.get('cacheTtlSeconds', 30)))
+
+
+def cached_query(cache_key, query_args, if_none_match=None):
+    """Returns the encoded body and ETag for a query, only running the query
+    if no usable response is cached. NotModified is raised as soon as it's
+    known that the client already has the current version.
+
+    Within the TTL a cached body is returned without reading the version, so
+    the TTL bounds how stale an unconditional response can be. Conditional
+    requests always check the version, a 304 is only sent for the current
+    one."""
+    user_id = cache_key[0]
+    consistent = query_args.get('ConsistentRead', False)
+    # Consistent reads are asked for when the app needs to see its own
+    # writes, so they never use the cache.
+    entry = None if consistent else cache.get(cache_key)
+    if entry and entry['expires'] > time.time() and not if_none_match:
+        cache.hits += 1
+        logger.info("Cache hit for user {}".format(user_id))
+        return entry['value'], make_etag(cache_key, entry['version'])
+
+    version = get_item_version(user_id, consistent)
+    etag = make_etag(cache_key, version)
+    check_not_modified(etag, if_none_match)
+    if entry and entry['version'] == version:
+        cache.hits += 1
+        cache.refresh(cache_key)
+        logger.info("Cache revalidated for user {}".format(user_id))
+        return entry['value'], etag
+
+    body = run_query(query_args)
+    if not consistent:
+        cache.misses += 1
+        logger.info("Cache miss for user {} (hits: {}, misses: {}, bytes: "
+                    "{})".format(user_id, cache.hits, cache.misses,
+                                 cache.size))
+        cache.put(cache_key, body, version)
+    return body, etag
+
+
+def check_not_modified(etag, if_none_match):
+    """Raises NotModified if etag matches the If-None-Match header"""
+    if not if_none_match:
+        return
+    client_etags = [client_etag.strip().replace('W/', '', 1)
+                    for client_etag in if_none_match.split(',')]
+    if '*' in client_etags or etag in client_etags:
+        # API GW sets the ETag header of the 304 from the message
+        raise NotModified("Not Modified {}".format(etag))
+
+
+def json_default(value):
+    """Converts types json can't handle, Decimal being by far the most
+    common as DynamoDB returns all numbers as one."""
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError("{} is not JSON serializable".format(type(value)))
+
+
+def encode_response(response):
+    """Encodes a query response into the compact JSON body returned to the
+    app, leaving behind transport details like ResponseMetadata and
+    ScannedCount."""
+    last_evaluated_key = response.get('LastEvaluatedKey')
+    body = {
+        'Items': response['Items'],
+        'Count': response['Count'],
+        'NextCursor': (encode_cursor(last_evaluated_key)
+                       if last_evaluated_key else None)
+    }
+    return json.dumps(body, default=json_default, separators=(',', ':'))
+
+
+def category_condition(params):
+    """Builds the condition on the category_name range key, if any.
+
+    Only one of an exact category, a category prefix or a category range
+    (from and/or to, both inclusive) can be used at a time."""
+    category = Key('category_name')
+    conditions = []
+    if params.get('category'):
+        conditions.append(category.eq(params['category']))
+    if params.get('category_prefix'):
+        conditions.append(category.begins_with(params['category_prefix']))
+    if params.get('category_from') and params.get('category_to'):
+        if params['category_from'] > params['category_to']:
+            raise ValueError("Bad Request: category_from must not come after "
+                             "category_to")
+        conditions.append(category.between(params['category_from'],
+                                           params['category_to']))
+    elif params.get('category_from'):
+        conditions.append(category.gte(params['category_from']))
+    elif params.get('category_to'):
+        conditions.append(category.lte(params['category_to']))
+
+    if len(conditions) > 1:
+        raise ValueError("Bad Request: only one of category, category_prefix "
+                         "or category_from/category_to can be used")
+    return conditions[0] if conditions else None
+
+
+def decode_cursor(cursor, user_id):
+    """Turns an opaque cursor back into the ExclusiveStartKey it was built
+    from. A cursor is only valid for the user it was handed out to."""
+    try:
+        start_key = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise ValueError("Bad Request: invalid cursor")
+    if type(start_key) is not dict or start_key.get('user_id') != user_id:
+        raise ValueError("Bad Request: invalid cursor")
+    return start_key
+
+
+def encode_cursor(last_evaluated_key):
+    """Builds an opaque cursor from a query's LastEvaluatedKey"""
+    return base64.urlsafe_b64encode(
+        json.dumps(last_evaluated_key, sort_keys=True).encode()).decode()
+
+
+def get_fields(params):
+    """Returns the attributes to read, optionally narrowed down by a comma
+    separated allow-list in the fields param."""
+    if not params.get('fields'):
+        return ITEM_ATTRIBUTES
+    fields = [field.strip() for field in params['fields'].split(',')]
+    unknown_fields = set(fields) - set(ITEM_ATTRIBUTES)
+    if unknown_fields:
+        raise ValueError("Bad Request: unknown fields {}".format(
+            ', '.join(sorted(unknown_fields))))
+    return [field for field in ITEM_ATTRIBUTES if field in fields]
+
+
+def get_item_version(user_id, consistent=False):
+    """Returns the version of the user's items, 0 if never written"""
+    response = version_table.get_item(
+        Key={'user_id': user_id},
+        ProjectionExpression='#version',
+        ExpressionAttributeNames={'#version': 'version'},
+        ConsistentRead=consistent
+    )
+    return int(response.get('Item', {}).get('version', 0))
+
+
+def get_page_size(params):
+    """Returns the client requested page size clamped to sane bounds"""
+    try:
+        page_size = int(params.get('limit') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        raise ValueError("Bad Request: limit must be an integer")
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
 
 def lambda_handler(event, context):
     api_request_id = event['metadata']['requestId']
     user_id = event['metadata']['userId']
+    params = event.get('params') or {}
+    if_none_match = (event.get('headers') or {}).get('If-None-Match')
     logger.info("Handling API request {} for user {}".format(api_request_id,
                                                               user_id))
-    response = table.query(
-        KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-    return response
+    key_condition = Key('user_id').eq(user_id)
+    range_condition = category_condition(params)
+    if range_condition:
+        key_condition = key_condition & range_condition
+    order = params.get('order') or 'asc'
+    if order not in ('asc', 'desc'):
+        raise ValueError("Bad Request: order must be asc or desc")
+    query_args = {
+        'KeyConditionExpression': key_condition,
+        'ProjectionExpression': ', '.join(get_fields(params)),
+        'Limit': get_page_size(params),
+        'ScanIndexForward': order == 'asc'
+    }
+    if params.get('cursor'):
+        query_args['ExclusiveStartKey'] = decode_cursor(params['cursor'],
+                                                        user_id)
+
+    if params.get('consistent') == 'true':
+        query_args['ConsistentRead'] = True
+
+    cache_key = (user_id,) + tuple(params.get(name) for name in QUERY_PARAMS)
+    body, etag = cached_query(cache_key, query_args, if_none_match)
+    # The body is already JSON, API GW passes it through as is and sets the
+    # ETag header from etag
+    return {'body': body, 'etag': etag}
+
+
+def make_etag(cache_key, version):
+    """The ETag of a response only changes when the user's items are
+    written, or when different query params are used."""
+    digest = sha1(json.dumps([cache_key, version]).encode()).hexdigest()
+    return '"{}"'.format(digest)
+
+
+def run_query(query_args):
+    """Queries the table and returns the encoded response body"""
+    try:
+        response = table.query(**query_args)
+    except ClientError as e:
+        # Such as a cursor handed out for other category filters
+        if e.response['Error']['Code'] == 'ValidationException':
+            raise ValueError("Bad Request: {}".format(
+                e.response['Error']['Message']))
+        raise
+    return encode_response(response)
 
 
@@ -1,12 +1,225 @@
 #!/usr/bin/env python3
+import json
+
+import pytest
+
+import get_items
 from get_items import *
 
 
+class Clock:
+    """Stands in for time.time() so TTLs can run out instantly"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    stub = Clock()
+    monkeypatch.setattr(time, 'time', stub)
+    return stub
+
+
+@pytest.fixture
+def item_cache(monkeypatch, clock):
+    """A fresh cache in place of the module's, with stubbed reads so only
+    the cache is under test."""
+    stub = ItemCache(max_bytes=10, ttl=30)
+    versions = {'pager': 1}
+    queries = []
+
+    def run_query(query_args):
+        queries.append(query_args)
+        return 'body-{}'.format(len(queries))
+
+    monkeypatch.setattr(get_items, 'cache', stub)
+    monkeypatch.setattr(get_items, 'get_item_version',
+                        lambda user_id, consistent=False: versions[user_id])
+    monkeypatch.setattr(get_items, 'run_query', run_query)
+    stub.versions = versions
+    stub.queries = queries
+    return stub
+
+
+def get_body(params, user_id='pager'):
+    event = {'metadata': {'userId': user_id,
+                          'requestId': __name__},
+             'params': params}
+    return json.loads(lambda_handler(event, None)['body'])
+
+
 def test_lambda_handler():
     event = {'metadata': {'userId': 'jjk3',
                           'requestId': __name__}}
     expected_items = [{'user_id': 'jjk3',
                        'category_name': 'bbq',
                        'place_name': 'central bbq'}]
+    response = json.loads(lambda_handler(event, None)['body'])
+    assert response == {'Items': expected_items,
+                        'Count': 1,
+                        'NextCursor': None}
+
+
+def test_lambda_handler_pagination():
+    first_page = get_body({'limit': '2'})
+    assert [item['category_name'] for item in first_page['Items']] == [
+        'bbq', 'pizza']
+    assert first_page['NextCursor']
+
+    second_page = get_body({'limit': '2', 'cursor': first_page['NextCursor']})
+    assert [item['category_name'] for item in second_page['Items']] == [
+        'tacos']
+    assert second_page['NextCursor'] is None
+
+
+def test_lambda_handler_rejects_foreign_cursor():
+    cursor = encode_cursor({'user_id': 'pager', 'category_name': 'bbq'})
+    with pytest.raises(ValueError):
+        get_body({'cursor': cursor}, user_id='jjk3')
+
+
+def test_lambda_handler_category_filters():
+    def categories(params):
+        return [item['category_name'] for item in get_body(params)['Items']]
+
+    assert categories({'category': 'pizza'}) == ['pizza']
+    assert categories({'category_prefix': 'ta'}) == ['tacos']
+    assert categories({'category_from': 'c', 'category_to': 'q'}) == ['pizza']
+    assert categories({'category_from': 'p'}) == ['pizza', 'tacos']
+    assert categories({'order': 'desc', 'limit': '2'}) == ['tacos', 'pizza']
+    assert categories({'consistent': 'true'}) == ['bbq', 'pizza', 'tacos']
+
+
+def test_lambda_handler_conflicting_filters():
+    with pytest.raises(ValueError):
+        get_body({'category': 'bbq', 'category_prefix': 'b'})
+
+
+def test_lambda_handler_reversed_range():
+    with pytest.raises(ValueError):
+        get_body({'category_from': 'q', 'category_to': 'c'})
+
+
+def test_lambda_handler_cursor_other_filters():
+    # The cursor points at bbq, outside of the pizza category
+    cursor = get_body({'limit': '1'})['NextCursor']
+    with pytest.raises(ValueError) as excinfo:
+        get_body({'category': 'pizza', 'cursor': cursor})
+    assert str(excinfo.value).startswith('Bad Request: ')
+
+
+def test_lambda_handler_fields():
+    response = get_body({'fields': 'place_name', 'category': 'bbq'})
+    assert response['Items'] == [{'place_name': 'central bbq'}]
+    with pytest.raises(ValueError):
+        get_body({'fields': 'place_name,secret'})
+
+
+def test_encode_response():
+    response = {'Items': [{'rank': Decimal('1'), 'rating': Decimal('4.5')}],
+                'Count': 1,
+                'ScannedCount': 1,
+                'ResponseMetadata': {'HTTPStatusCode': 200}}
+    assert encode_response(response) == (
+        '{"Items":[{"rank":1,"rating":4.5}],"Count":1,"NextCursor":null}')
+
+
+def test_lambda_handler_etag():
+    event = {'metadata': {'userId': 'pager',
+                          'requestId': __name__},
+             'params': {'category': 'pizza'}}
+    etag = lambda_handler(event, None)['etag']
+    event['headers'] = {'If-None-Match': etag}
+    with pytest.raises(NotModified) as excinfo:
+        lambda_handler(event, None)
+    assert str(excinfo.value) == 'Not Modified {}'.format(etag)
+
+    event['params']['category'] = 'tacos'
     response = lambda_handler(event, None)
-    assert response['Items'] == expected_items
+    assert response['etag'] != etag
+    assert json.loads(response['body'])['Items'][0]['category_name'] == 'tacos'
+
+
+def test_item_cache_lru_eviction(clock):
+    cache = ItemCache(max_bytes=10, ttl=30)
+    cache.put('a', 'aaaa', 1)
+    cache.put('b', 'bbbb', 1)
+    # Reading a makes b the least recently used
+    assert cache.get('a')['value'] == 'aaaa'
+    cache.put('c', 'cccc', 1)
+    assert cache.get('b') is None
+    assert cache.get('a')['value'] == 'aaaa'
+    assert cache.get('c')['value'] == 'cccc'
+    assert cache.size == 8
+
+
+def test_item_cache_too_large(clock):
+    cache = ItemCache(max_bytes=10, ttl=30)
+    cache.put('a', 'aaaa', 1)
+    cache.put('big', 'x' * 11, 1)
+    assert cache.get('big') is None
+    assert cache.get('a')['value'] == 'aaaa'
+    # Replacing an entry with one too large drops the old one
+    cache.put('a', 'x' * 11, 2)
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_item_cache_ttl(item_cache, clock):
+    cache_key = ('pager', 'pizza')
+    assert cached_query(cache_key, {}) == ('body-1', make_etag(cache_key, 1))
+    assert (item_cache.hits, item_cache.misses) == (0, 1)
+
+    clock.now += 29
+    item_cache.versions['pager'] = 2
+    # Still within the TTL, the version isn't even read
+    assert cached_query(cache_key, {})[0] == 'body-1'
+    assert (item_cache.hits, item_cache.misses) == (1, 1)
+    assert len(item_cache.queries) == 1
+
+
+def test_item_cache_conditional(item_cache, clock):
+    cache_key = ('pager', 'pizza')
+    etag = cached_query(cache_key, {})[1]
+    with pytest.raises(NotModified):
+        cached_query(cache_key, {}, if_none_match=etag)
+
+    # Within the TTL, but the version is checked before answering a
+    # conditional request
+    item_cache.versions['pager'] = 2
+    assert cached_query(cache_key, {}, if_none_match=etag) == (
+        'body-2', make_etag(cache_key, 2))
+
+
+def test_item_cache_revalidate_unchanged(item_cache, clock):
+    cache_key = ('pager', 'pizza')
+    cached_query(cache_key, {})
+    clock.now += 31
+    assert cached_query(cache_key, {}) == ('body-1', make_etag(cache_key, 1))
+    assert (item_cache.hits, item_cache.misses) == (1, 1)
+    assert len(item_cache.queries) == 1
+    # Revalidating starts the TTL over
+    assert item_cache.get(cache_key)['expires'] == clock.now + 30
+
+
+def test_item_cache_revalidate_bumped(item_cache, clock):
+    cache_key = ('pager', 'pizza')
+    cached_query(cache_key, {})
+    clock.now += 31
+    item_cache.versions['pager'] = 2
+    assert cached_query(cache_key, {}) == ('body-2', make_etag(cache_key, 2))
+    assert (item_cache.hits, item_cache.misses) == (0, 2)
+    assert item_cache.get(cache_key)['version'] == 2
+
+
+def test_item_cache_consistent(item_cache, clock):
+    cache_key = ('pager', 'pizza')
+    cached_query(cache_key, {})
+    assert cached_query(cache_key, {'ConsistentRead': True})[0] == 'body-2'
+    # Consistent reads neither use nor count against the cache
+    assert (item_cache.hits, item_cache.misses) == (0, 1)
+    assert item_cache.get(cache_key)['value'] == 'body-1'
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Serves the places most saved as the bestest of a category, read straight
+off the counts kept up to date by item_stream."""
+import logging
+import os
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+if ('AWS_DEFAULT_REGION' in os.environ
+    and os.environ['AWS_DEFAULT_REGION'] != 'LOCAL'):
+    region = os.environ['AWS_DEFAULT_REGION']
+    logger.info("Using DynamoDB instance in {} region".format(region))
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              region_name=region)
+else:
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              endpoint_url='http://localhost:8000')
+    logger.info("Using local DynamoDB instance")
+
+count_table = dynamodb.Table(os.environ['categoryCountsTableName'])
+
+# Local secondary index of count_table sorted by save_count
+COUNT_INDEX = 'ByCount'
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+
+def lambda_handler(event, context):
+    api_request_id = event['metadata']['requestId']
+    params = event.get('params') or {}
+    category_name = params.get('category')
+    if not category_name:
+        raise ValueError("Bad Request: category is required")
+    try:
+        limit = int(params.get('limit') or DEFAULT_LIMIT)
+    except ValueError:
+        raise ValueError("Bad Request: limit must be an integer")
+    limit = max(1, min(limit, MAX_LIMIT))
+    logger.info("Handling API request {} for top {} of {}".format(
+        api_request_id, limit, category_name))
+
+    response = count_table.query(
+        IndexName=COUNT_INDEX,
+        KeyConditionExpression=(Key('category_name').eq(category_name)
+                                & Key('save_count').gt(0)),
+        ScanIndexForward=False,
+        Limit=limit
+    )
+    places = [{'place_name': item['place_name'],
+               'save_count': int(item['save_count'])}
+              for item in response['Items']]
+    return {'Category': category_name, 'Places': places}
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import pytest
+
+from get_leaderboard import *
+
+
+def test_lambda_handler():
+    counts = {'first': 5, 'second': 3, 'third': 1, 'gone': 0}
+    for place_name, save_count in counts.items():
+        count_table.put_item(Item={'category_name': 'leaderboardtest',
+                                   'place_name': place_name,
+                                   'save_count': save_count})
+    event = {'metadata': {'userId': 'jjk3',
+                          'requestId': __name__},
+             'params': {'category': 'leaderboardtest', 'limit': '2'}}
+    response = lambda_handler(event, None)
+    assert response == {'Category': 'leaderboardtest',
+                        'Places': [{'place_name': 'first', 'save_count': 5},
+                                   {'place_name': 'second', 'save_count': 3}]}
+
+    event['params']['limit'] = '10'
+    response = lambda_handler(event, None)
+    assert [place['place_name'] for place in response['Places']] == [
+        'first', 'second', 'third']
+
+
+def test_lambda_handler_requires_category():
+    event = {'metadata': {'userId': 'jjk3',
+                          'requestId': __name__}}
+    with pytest.raises(ValueError):
+        lambda_handler(event, None)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Imports items in bulk, either posted to the API by a user or as a JSONL
+file dropped in the import bucket.
+
+Items are de-duplicated by key, written with BatchWriteItem from several
+threads at once and the outcome of every item is reported back.
+"""
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+if ('AWS_DEFAULT_REGION' in os.environ
+    and os.environ['AWS_DEFAULT_REGION'] != 'LOCAL'):
+    region = os.environ['AWS_DEFAULT_REGION']
+    logger.info("Using DynamoDB instance in {} region".format(region))
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              region_name=region)
+else:
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              endpoint_url='http://localhost:8000')
+    logger.info("Using local DynamoDB instance")
+
+table = dynamodb.Table(os.environ['itemsTableName'])
+# batch_write runs on worker threads, so it goes through the client, which
+# can be shared between them where the Table resource can't.
+client = dynamodb.meta.client
+
+ITEM_ATTRIBUTES = ['user_id', 'category_name', 'place_name']
+# Key attributes are hash or range keys of the items or category counts
+# tables, which cap their size in bytes
+MAX_KEY_BYTES = {'user_id': 2048, 'category_name': 1024, 'place_name': 1024}
+# BatchWriteItem takes at most 25 items per call
+BATCH_WRITE_SIZE = 25
+# Items per API request, enough to be written within API Gateway's 29s
+# timeout at the table's provisioned throughput. Larger imports go through
+# the import bucket.
+MAX_ITEMS = 500
+MAX_RETRIES = 8
+MAX_WORKERS = int(os.environ.get('importWorkers', 8))
+# Lines of a JSONL file handled at a time, bounds memory use for big files
+S3_BLOCK_SIZE = 5000
+
+
+def backoff(attempt):
+    """Sleeps for an exponentially growing, jittered, amount of time"""
+    time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+
+
+def batch_write(items):
+    """Writes up to BATCH_WRITE_SIZE items, retrying any unprocessed items.
+    Returns the keys of the items that could not be written, mapped to the
+    reason why."""
+    request_items = {
+        table.name: [{'PutRequest': {'Item': item}} for item in items]
+    }
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = client.batch_write_item(RequestItems=request_items)
+        except ClientError as e:
+            # Only fails this batch, the others are still written and
+            # reported on
+            logger.exception("Failed writing a batch of {} items".format(
+                len(request_items[table.name])))
+            return {item_key(request['PutRequest']['Item']):
+                    e.response['Error']['Code']
+                    for request in request_items[table.name]}
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return {}
+        logger.info("Retrying {} unprocessed items".format(
+            len(request_items[table.name])))
+        backoff(attempt)
+    return {item_key(request['PutRequest']['Item']): 'throttled'
+            for request in request_items[table.name]}
+
+
+def import_items(raw_items, user_id=None, written=None):
+    """Validates, de-duplicates and writes items, returning the outcome of
+    each item in the same order as raw_items.
+
+    When user_id is given every item is imported for that user. Of items
+    sharing a key, the last one is written and the others are reported as
+    duplicates. written carries that across calls, it maps the key of each
+    item written so far to its outcome, which is changed to a duplicate if
+    the key is written again."""
+    outcomes = [None] * len(raw_items)
+    items_by_key = {}
+    for index, raw_item in enumerate(raw_items):
+        try:
+            item = validate_item(raw_item, user_id)
+        except ValueError as e:
+            outcomes[index] = {'index': index, 'status': 'invalid',
+                               'reason': str(e)}
+            continue
+        key = item_key(item)
+        if key in items_by_key:
+            duplicate_index = items_by_key[key][0]
+            outcomes[duplicate_index] = {'index': duplicate_index,
+                                         'status': 'duplicate'}
+        items_by_key[key] = (index, item)
+
+    indexed_items = sorted(items_by_key.values())
+    batches = [[item for index, item in indexed_items[i:i + BATCH_WRITE_SIZE]]
+               for i in range(0, len(indexed_items), BATCH_WRITE_SIZE)]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        failed_keys = {}
+        for batch_failed_keys in executor.map(batch_write, batches):
+            failed_keys.update(batch_failed_keys)
+
+    for key, (index, item) in items_by_key.items():
+        if key in failed_keys:
+            outcomes[index] = {'index': index, 'status': 'failed',
+                               'reason': failed_keys[key]}
+        else:
+            outcomes[index] = {'index': index, 'status': 'written'}
+            if written is not None:
+                if key in written:
+                    written[key]['status'] = 'duplicate'
+                written[key] = outcomes[index]
+    return outcomes
+
+
+def import_s3_object(bucket, key):
+    """Imports a JSONL file from S3 a block of lines at a time. A report of
+    the outcome of each line is written next to it, indexed by the line's
+    number in the file counting from 0. Blank lines aren't reported on."""
+    s3 = boto3.client('s3')
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    outcomes = []
+    written = {}
+    block = []
+    line_numbers = []
+    for line_number, line in enumerate(iter_lines(body)):
+        if not line.strip():
+            continue
+        try:
+            block.append(json.loads(line.decode()))
+        except ValueError:
+            # Reported as invalid
+            block.append(None)
+        line_numbers.append(line_number)
+        if len(block) == S3_BLOCK_SIZE:
+            outcomes.extend(number_outcomes(
+                import_items(block, written=written), line_numbers))
+            block = []
+            line_numbers = []
+    if block:
+        outcomes.extend(number_outcomes(import_items(block, written=written),
+                                        line_numbers))
+
+    summary = summarize(outcomes)
+    report_key = 'reports/' + key + '.json'
+    logger.info("Imported s3://{}/{} {}, report at {}".format(
+        bucket, key, summary, report_key))
+    s3.put_object(Bucket=bucket,
+                  Key=report_key,
+                  Body=json.dumps(dict(summary, Outcomes=outcomes)).encode())
+    return summary
+
+
+def item_key(item):
+    return (item['user_id'], item['category_name'])
+
+
+def iter_lines(body, chunk_size=1024 * 1024):
+    """Yields the lines of a file like object without reading it all in"""
+    pending = b''
+    for chunk in iter(lambda: body.read(chunk_size), b''):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def lambda_handler(event, context):
+    """Handles both S3 notifications for the import bucket and API
+    requests."""
+    if 'Records' in event:
+        # Keys in S3 notifications are URL encoded
+        return [import_s3_object(record['s3']['bucket']['name'],
+                                 unquote_plus(record['s3']['object']['key']))
+                for record in event['Records']]
+
+    api_request_id = event['metadata']['requestId']
+    user_id = event['metadata']['userId']
+    raw_items = (event.get('data') or {}).get('items')
+    if type(raw_items) is not list:
+        raise ValueError("Bad Request: items must be a list")
+    if len(raw_items) > MAX_ITEMS:
+        raise ValueError(
+            "Bad Request: at most {} items per request, import more through "
+            "the import bucket".format(MAX_ITEMS))
+    logger.info("Handling API request {} for user {} with {} items".format(
+        api_request_id, user_id, len(raw_items)))
+    outcomes = import_items(raw_items, user_id)
+    summary = summarize(outcomes)
+    logger.info("Imported {}".format(summary))
+    return dict(summary, Outcomes=outcomes)
+
+
+def number_outcomes(outcomes, line_numbers):
+    """Changes the index of each outcome of a block to the number of the
+    line the item was on"""
+    for outcome in outcomes:
+        outcome['index'] = line_numbers[outcome['index']]
+    return outcomes
+
+
+def summarize(outcomes):
+    summary = {'Written': 0, 'Duplicate': 0, 'Invalid': 0, 'Failed': 0}
+    for outcome in outcomes:
+        summary[outcome['status'].capitalize()] += 1
+    return summary
+
+
+def validate_item(raw_item, user_id=None):
+    """Returns a clean copy of raw_item holding only known attributes"""
+    if type(raw_item) is not dict:
+        raise ValueError("item must be an object")
+    item = {attribute: raw_item.get(attribute)
+            for attribute in ITEM_ATTRIBUTES}
+    if user_id:
+        item['user_id'] = user_id
+    for attribute in ITEM_ATTRIBUTES:
+        if type(item[attribute]) is not str or not item[attribute]:
+            raise ValueError("{} must be a non-empty string".format(attribute))
+        if len(item[attribute].encode()) > MAX_KEY_BYTES[attribute]:
+            raise ValueError("{} must be at most {} bytes".format(
+                attribute, MAX_KEY_BYTES[attribute]))
+    return item
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import io
+import json
+
+import pytest
+
+from import_items import *
+
+
+def test_lambda_handler():
+    event = {'metadata': {'userId': 'importer',
+                          'requestId': __name__},
+             'data': {'items': [
+                 {'category_name': 'bbq', 'place_name': 'central bbq'},
+                 {'category_name': 'pizza', 'place_name': 'aldos'},
+                 {'category_name': 'bbq', 'place_name': 'AJs'},
+                 {'category_name': 'tacos'},
+                 # user_id is always that of the caller
+                 {'user_id': 'jjk3', 'category_name': 'sushi',
+                  'place_name': 'sekisui'}
+             ]}}
+    response = lambda_handler(event, None)
+    assert [outcome['status'] for outcome in response['Outcomes']] == [
+        'duplicate', 'written', 'written', 'invalid', 'written']
+    assert response['Written'] == 3
+    assert response['Duplicate'] == 1
+    assert response['Invalid'] == 1
+
+    item = table.get_item(Key={'user_id': 'importer',
+                               'category_name': 'bbq'})['Item']
+    assert item['place_name'] == 'AJs'
+    assert 'Item' not in table.get_item(Key={'user_id': 'jjk3',
+                                             'category_name': 'sushi'})
+
+    for category_name in ['bbq', 'pizza', 'sushi']:
+        table.delete_item(Key={'user_id': 'importer',
+                               'category_name': category_name})
+
+
+def test_lambda_handler_not_a_list():
+    event = {'metadata': {'userId': 'importer',
+                          'requestId': __name__},
+             'data': {'items': 'bbq'}}
+    with pytest.raises(ValueError):
+        lambda_handler(event, None)
+
+
+def test_validate_item_key_size():
+    with pytest.raises(ValueError):
+        validate_item({'category_name': 'x' * 1025, 'place_name': 'aldos'},
+                      'importer')
+    assert validate_item({'category_name': 'x' * 1024,
+                          'place_name': 'aldos'}, 'importer')
+
+
+def test_iter_lines():
+    body = io.BytesIO(b'{"a": 1}\n{"b": 2}\n\n{"c": 3}')
+    assert list(iter_lines(body, chunk_size=3)) == [
+        b'{"a": 1}', b'{"b": 2}', b'', b'{"c": 3}']
+
+
+class StubS3:
+    """Stands in for the S3 client, serving one file and keeping the report
+    written for it"""
+
+    def __init__(self, data):
+        self.data = data
+        self.report = None
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.data)}
+
+    def put_object(self, Bucket, Key, Body):
+        self.report = json.loads(Body.decode())
+
+
+def test_import_s3_object(monkeypatch):
+    lines = [
+        {'user_id': 's3importer', 'category_name': 'bbq',
+         'place_name': 'central bbq'},
+        '',
+        'not json',
+        {'user_id': 's3importer', 'category_name': 'pizza',
+         'place_name': 'aldos'},
+        # Same key as the first line, but in the next block
+        {'user_id': 's3importer', 'category_name': 'bbq',
+         'place_name': 'AJs'}
+    ]
+    data = '\n'.join(line if type(line) is str else json.dumps(line)
+                     for line in lines).encode()
+    s3 = StubS3(data)
+    monkeypatch.setattr(boto3, 'client', lambda service_name: s3)
+    monkeypatch.setattr('import_items.S3_BLOCK_SIZE', 2)
+
+    summary = import_s3_object('bucket', 'imports/places.jsonl')
+    assert summary == {'Written': 2, 'Duplicate': 1, 'Invalid': 1,
+                       'Failed': 0}
+    assert [(outcome['index'], outcome['status'])
+            for outcome in s3.report['Outcomes']] == [
+        (0, 'duplicate'), (2, 'invalid'), (3, 'written'), (4, 'written')]
+
+    item = table.get_item(Key={'user_id': 's3importer',
+                               'category_name': 'bbq'})['Item']
+    assert item['place_name'] == 'AJs'
+    for category_name in ['bbq', 'pizza']:
+        table.delete_item(Key={'user_id': 's3importer',
+                               'category_name': category_name})
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Consumes the ItemTable DynamoDB stream and:
+
+* bumps the version of every user whose items changed. get_items uses the
+  version to decide if a cached response is still good.
+* keeps count of how many users have saved each place as the bestest of a
+  category, which get_leaderboard serves rankings from.
+
+Each record is applied in one transaction, which also saves the record's
+sequence number in AppliedSequenceTable, one small item per user and
+category that expires once the stream no longer holds the record. A record
+that was already applied, as happens when a batch is retried, is skipped,
+so counts aren't added twice. backfill_leaderboard can still rebuild them
+from scratch.
+"""
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+if ('AWS_DEFAULT_REGION' in os.environ
+    and os.environ['AWS_DEFAULT_REGION'] != 'LOCAL'):
+    region = os.environ['AWS_DEFAULT_REGION']
+    logger.info("Using DynamoDB instance in {} region".format(region))
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              region_name=region)
+else:
+    dynamodb = boto3.resource(service_name='dynamodb',
+                              endpoint_url='http://localhost:8000')
+    logger.info("Using local DynamoDB instance")
+
+version_table = dynamodb.Table(os.environ['itemVersionsTableName'])
+count_table = dynamodb.Table(os.environ['categoryCountsTableName'])
+applied_table = dynamodb.Table(os.environ['appliedSequencesTableName'])
+# Records are applied from worker threads through the client, which unlike
+# the Table resources can be shared between threads.
+client = dynamodb.meta.client
+
+# Stream records are kept for 24 hours, a retry can't come after that
+APPLIED_TTL = 2 * 24 * 60 * 60
+# Sequence numbers are up to 40 digits, too many for a DynamoDB number, so
+# they're saved as strings padded to compare in order
+SEQUENCE_LENGTH = 40
+MAX_WORKERS = int(os.environ.get('streamWorkers', 8))
+
+
+def count_deltas(records):
+    """Returns the change in count of each (category_name, place_name) from
+    a batch of stream records, leaving out those that net to zero."""
+    deltas = Counter()
+    for record in records:
+        for image, delta in (('OldImage', -1), ('NewImage', 1)):
+            item = record['dynamodb'].get(image, {})
+            if 'category_name' in item and 'place_name' in item:
+                deltas[(item['category_name']['S'],
+                        item['place_name']['S'])] += delta
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def apply_record(record):
+    """Bumps the version of the record's user and adjusts the counts of the
+    places it changed, unless the record was already applied. Returns False
+    if it was."""
+    keys = record['dynamodb']['Keys']
+    user_id = keys['user_id']['S']
+    category_name = keys['category_name']['S']
+    sequence_number = record['dynamodb']['SequenceNumber'].zfill(
+        SEQUENCE_LENGTH)
+    transact_items = [{
+        'Update': {
+            'TableName': applied_table.name,
+            'Key': {'user_id': user_id, 'category_name': category_name},
+            'UpdateExpression': ('SET applied_sequence = :sequence, '
+                                 'expires = :expires'),
+            'ConditionExpression': ('attribute_not_exists(applied_sequence) '
+                                    'OR applied_sequence < :sequence'),
+            'ExpressionAttributeValues': {
+                ':sequence': sequence_number,
+                ':expires': int(time.time()) + APPLIED_TTL
+            }
+        }
+    }, {
+        'Update': {
+            'TableName': version_table.name,
+            'Key': {'user_id': user_id},
+            'UpdateExpression': 'ADD #version :one',
+            'ExpressionAttributeNames': {'#version': 'version'},
+            'ExpressionAttributeValues': {':one': 1}
+        }
+    }]
+    for (category, place_name), delta in sorted(
+            count_deltas([record]).items()):
+        transact_items.append({
+            'Update': {
+                'TableName': count_table.name,
+                'Key': {'category_name': category, 'place_name': place_name},
+                'UpdateExpression': 'ADD save_count :delta',
+                'ExpressionAttributeValues': {':delta': delta}
+            }
+        })
+    try:
+        client.transact_write_items(TransactItems=transact_items)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        # Not every botocore parses the cancellation reasons, so the
+        # applied sequence is read back to tell a replay from a failure
+        if applied_sequence(user_id, category_name) < sequence_number:
+            raise
+        logger.info("Record {} already applied".format(
+            record['dynamodb']['SequenceNumber']))
+        return False
+    return True
+
+
+def applied_sequence(user_id, category_name):
+    """Returns the padded sequence number of the last record applied for an
+    item, or an empty string if there's none."""
+    response = client.get_item(
+        TableName=applied_table.name,
+        Key={'user_id': user_id, 'category_name': category_name},
+        ProjectionExpression='applied_sequence',
+        ConsistentRead=True
+    )
+    return response.get('Item', {}).get('applied_sequence', '')
+
+
+def apply_records(records):
+    """Applies the records of one item in order, returns how many were
+    applied."""
+    return sum(1 for record in records if apply_record(record))
+
+
+def lambda_handler(event, context):
+    # A record is only applied if it's newer than the last one applied for
+    # its item, so each item's records are applied in order. Items are
+    # applied in parallel.
+    records_by_item = OrderedDict()
+    for record in event['Records']:
+        keys = record['dynamodb']['Keys']
+        item_key = (keys['user_id']['S'], keys['category_name']['S'])
+        records_by_item.setdefault(item_key, []).append(record)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        applied = sum(executor.map(apply_records, records_by_item.values()))
+    logger.info("Applied {} of {} records for {} items".format(
+        applied, len(event['Records']), len(records_by_item)))
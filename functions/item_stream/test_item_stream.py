@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import itertools
+import time
+
+from item_stream import *
+
+# Stream sequence numbers only ever grow, also across test runs
+sequence_numbers = itertools.count(int(time.time() * 1000000))
+
+
+def stream_record(user_id, category_name, event_name='INSERT',
+                  old_place_name=None, new_place_name=None):
+    record = {'eventName': event_name,
+              'dynamodb': {'Keys': {'user_id': {'S': user_id},
+                                    'category_name': {'S': category_name}},
+                           'SequenceNumber': str(next(sequence_numbers))}}
+    for image, place_name in (('OldImage', old_place_name),
+                              ('NewImage', new_place_name)):
+        if place_name:
+            record['dynamodb'][image] = {
+                'user_id': {'S': user_id},
+                'category_name': {'S': category_name},
+                'place_name': {'S': place_name}
+            }
+    return record
+
+
+def get_version(user_id):
+    response = version_table.get_item(Key={'user_id': user_id})
+    return response.get('Item', {}).get('version', 0)
+
+
+def get_applied_sequence(user_id, category_name):
+    response = applied_table.get_item(Key={'user_id': user_id,
+                                           'category_name': category_name})
+    return response['Item']['applied_sequence']
+
+
+def get_count(category_name, place_name):
+    response = count_table.get_item(Key={'category_name': category_name,
+                                         'place_name': place_name})
+    return response.get('Item', {}).get('save_count', 0)
+
+
+def test_lambda_handler():
+    start_version = get_version('streamer')
+    event = {'Records': [stream_record('streamer', 'bbq'),
+                         stream_record('streamer', 'pizza', 'MODIFY')]}
+    lambda_handler(event, None)
+    assert get_version('streamer') == start_version + 2
+
+
+def test_lambda_handler_counts():
+    event = {'Records': [
+        stream_record('streamer', 'streamtest', 'INSERT',
+                      new_place_name='first'),
+        stream_record('streamer2', 'streamtest', 'INSERT',
+                      new_place_name='first'),
+        stream_record('streamer', 'streamtest', 'MODIFY',
+                      old_place_name='first', new_place_name='second')
+    ]}
+    lambda_handler(event, None)
+    assert get_count('streamtest', 'first') == 1
+    assert get_count('streamtest', 'second') == 1
+
+
+def test_lambda_handler_retried_batch():
+    event = {'Records': [
+        stream_record('retrier', 'retrytest', 'INSERT',
+                      new_place_name='once')
+    ]}
+    lambda_handler(event, None)
+    start_version = get_version('retrier')
+    lambda_handler(event, None)
+    assert get_count('retrytest', 'once') == 1
+    assert get_version('retrier') == start_version
+    assert get_applied_sequence('retrier', 'retrytest').lstrip('0') == (
+        event['Records'][0]['dynamodb']['SequenceNumber'])
+
+
+def test_lambda_handler_version_item():
+    # Only the version is kept on the user's version item
+    lambda_handler({'Records': [stream_record('slim', 'slimtest')]}, None)
+    item = version_table.get_item(Key={'user_id': 'slim'})['Item']
+    assert set(item) == {'user_id', 'version'}
+
+
+def test_count_deltas():
+    records = [
+        stream_record('a', 'bbq', 'INSERT', new_place_name='AJs'),
+        stream_record('b', 'bbq', 'MODIFY', old_place_name='AJs',
+                      new_place_name='AJs'),
+        stream_record('c', 'bbq', 'REMOVE', old_place_name='central bbq')
+    ]
+    assert count_deltas(records) == {('bbq', 'AJs'): 1,
+                                     ('bbq', 'central bbq'): -1}
@@ -45,6 +45,10 @@ def prep_lambdas():
     gh_install = "pip install github3.py -t ./functions_deploy/pipeline/"
     subprocess.run(gh_install.split(), check=True)
 
+    # Pool stacks are created from the template packaged with the lambda
+    shutil.copy('./pipeline_deploy_stack.yaml',
+                './functions_deploy/pipeline/')
+
 
 def cfn_deploy(stack_name, template_path):
     cfn = boto3.client('cloudformation')
@@ -0,0 +1,121 @@
+"""Helpers for working with zip archives without extracting them to disk.
+
+zipfile has no public way of copying a member's compressed data from one
+archive to another, so write_raw_member() writes the member's local header
+itself and then registers the member with the destination ZipFile, which
+writes the central directory as usual when it's closed.
+"""
+import logging
+import struct
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP64_LIMIT
+
+logger = logging.getLogger()
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# Every member gets the same timestamp and one of two modes, so the same
+# files always repackage to the same bytes whatever commit they came from.
+# 1980 is the earliest a zip can record.
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+FILE_MODE = 0o100644
+EXECUTABLE_MODE = 0o100755
+CREATE_SYSTEM_UNIX = 3
+# Fixed size part of a local file header, followed by the name and extra
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# General purpose flag bits
+FLAG_ENCRYPTED = 0x1
+FLAG_COMPRESSION_OPTIONS = 0x6
+
+
+def is_executable(info):
+    """Tells if a member has any execute bit set, only archives made on
+    Unix record them."""
+    return (info.create_system == CREATE_SYSTEM_UNIX
+            and bool((info.external_attr >> 16) & 0o111))
+
+
+def iter_raw_data(src_zip, info):
+    """Yields the compressed data of a member as stored in the archive"""
+    fp = src_zip.fp
+    fp.seek(info.header_offset)
+    header = fp.read(LOCAL_HEADER_SIZE)
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile("Bad local header for {}".format(info.filename))
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    fp.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length
+            + extra_length)
+    remaining = info.compress_size
+    while remaining:
+        chunk = fp.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise BadZipFile("{} is truncated".format(info.filename))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def repackage(src, dest, strip_prefix=None):
+    """Copies the files in the zip archive src into a new zip archive dest
+    with strip_prefix removed from their names. src and dest may be paths or
+    file objects, dest doesn't need to be seekable.
+
+    Compressed data is copied as is, so nothing is decompressed or compressed
+    again and only one chunk of a member is held in memory at a time. If
+    strip_prefix isn't given, the single root dir GitHub puts everything
+    in is stripped.
+
+    Members are sorted by name and their timestamps and modes normalized,
+    GitHub stamps each with its commit's time.
+    """
+    with ZipFile(src) as src_zip, ZipFile(dest, mode='w') as dest_zip:
+        members = src_zip.infolist()
+        if strip_prefix is None:
+            strip_prefix = root_dir(members)
+        for info in sorted(members, key=lambda info: info.filename):
+            if info.is_dir() or not info.filename.startswith(strip_prefix):
+                continue
+            if info.flag_bits & FLAG_ENCRYPTED:
+                raise RuntimeError(
+                    "{} is encrypted and can't be copied".format(
+                        info.filename))
+            dest_info = ZipInfo(info.filename[len(strip_prefix):],
+                                date_time=FIXED_DATE_TIME)
+            dest_info.compress_type = info.compress_type
+            dest_info.create_system = CREATE_SYSTEM_UNIX
+            dest_info.external_attr = (
+                EXECUTABLE_MODE if is_executable(info) else FILE_MODE) << 16
+            # Sizes are written in the local header, so no data descriptor
+            dest_info.flag_bits = info.flag_bits & FLAG_COMPRESSION_OPTIONS
+            dest_info.CRC = info.CRC
+            dest_info.compress_size = info.compress_size
+            dest_info.file_size = info.file_size
+            logger.debug("copying {} to {}".format(info.filename,
+                                                   dest_info.filename))
+            write_raw_member(dest_zip, dest_info,
+                             iter_raw_data(src_zip, info))
+
+
+def root_dir(members):
+    """Returns the dir all members are in if the archive was made by GitHub,
+    which puts everything in a single <owner>-<repo>-<sha>/ dir, otherwise
+    an empty string."""
+    first_name = members[0].filename if members else ''
+    if first_name.endswith('/') and all(
+            info.filename.startswith(first_name) for info in members):
+        return first_name
+    return ''
+
+
+def write_raw_member(dest_zip, zinfo, chunks):
+    """Adds a member to dest_zip, an archive open for writing, from chunks of
+    data that are already compressed. zinfo's compress_type, CRC and sizes
+    must match the data."""
+    zip64 = (zinfo.file_size > ZIP64_LIMIT
+             or zinfo.compress_size > ZIP64_LIMIT)
+    zinfo.header_offset = dest_zip.fp.tell()
+    dest_zip.fp.write(zinfo.FileHeader(zip64))
+    for chunk in chunks:
+        dest_zip.fp.write(chunk)
+    dest_zip.filelist.append(zinfo)
+    dest_zip.NameToInfo[zinfo.filename] = zinfo
+    dest_zip.start_dir = dest_zip.fp.tell()
+    dest_zip._didModify = True
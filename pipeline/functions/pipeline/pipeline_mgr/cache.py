@@ -0,0 +1,191 @@
+"""Cache of S3 artifacts in /tmp, shared by the pipeline manager steps that
+run on the same warm container.
+
+Entries are keyed by (bucket, key, sha) and evicted least recently used
+first once they take up more than max_bytes. The SHA-256 of each file is
+recorded when it's added and checked every time it's handed out, so a file
+that was changed or cut short is dropped rather than used.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import shutil
+
+logger = logging.getLogger()
+
+CACHE_DIR = os.environ.get('PIPELINE_MGR_CACHE_DIR', '/tmp/artifacts')
+# /tmp is 512MB, leave room for zipballs and extracted trees
+CACHE_MAX_BYTES = int(os.environ.get('PIPELINE_MGR_CACHE_MAX_BYTES',
+                                     256 * 1024 * 1024))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as cached_file:
+        for chunk in iter(lambda: cached_file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ArtifactCache:
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        # The index is only kept in memory, so anything already on disk
+        # can't be trusted
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __path(self, key):
+        name = hashlib.sha1('\0'.join(str(part) for part in key).encode())
+        return os.path.join(self.cache_dir, name.hexdigest())
+
+    def add(self, key, path, hexdigest):
+        """Moves the file at path into the cache, returns its new path or
+        None if it's too large to cache, in which case it's left as is."""
+        self.evict(key)
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            logger.info("{} bytes too large to cache".format(size))
+            return None
+        self.make_room(size)
+        cached_path = self.__path(key)
+        os.replace(path, cached_path)
+        self._entries[key] = {
+            'path': cached_path,
+            'sha256': hexdigest,
+            'size': size
+        }
+        self._size += size
+        logger.info("Cached {} as {} ({} bytes in cache)".format(
+            key, cached_path, self._size))
+        return cached_path
+
+    def clear(self):
+        for key in list(self._entries):
+            self.evict(key)
+
+    def evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= entry['size']
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        """Returns the path of the cached file for key, or None"""
+        entry = self._entries.get(key)
+        if entry and file_digest(entry['path']) != entry['sha256']:
+            logger.warning("Cached {} failed its integrity check".format(key))
+            self.evict(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            logger.info("Artifact cache miss for {}".format(key))
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        logger.info("Artifact cache hit for {}".format(key))
+        return entry['path']
+
+    def make_room(self, size):
+        """Evicts the least recently used files until size more bytes fit"""
+        while self._entries and self._size + size > self.max_bytes:
+            self.evict(next(iter(self._entries)))
+
+    def path_for_download(self, key):
+        """Returns a path to download a file for key to before add()"""
+        return self.__path(key) + '.part'
+
+    @property
+    def size(self):
+        return self._size
+
+    def writer(self, key):
+        """Returns a file object that adds what's written to it to the cache
+        as key once it's closed cleanly. Caching is best effort, writes never
+        fail."""
+        return CacheWriter(self, key)
+
+
+class CacheWriter:
+    """Write only file object used as a context manager, see
+    ArtifactCache.writer().
+
+    It's written to alongside an upload, so once the file can't be cached,
+    because it's grown past max_bytes or /tmp is full, the partial file is
+    dropped and the rest of what's written is discarded.
+    """
+
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        self._path = cache.path_for_download(key)
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+        try:
+            self._file = open(self._path, 'wb')
+        except OSError as e:
+            logger.warning("Not caching {}: {}".format(key, e))
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+            if not exc_type and self._cache.add(self._key, self._path,
+                                                self._sha256.hexdigest()):
+                return
+        except OSError as e:
+            logger.warning("Not caching {}: {}".format(self._key, e))
+        self.__remove()
+
+    def __abandon(self, reason):
+        logger.info("Not caching {}: {}".format(self._key, reason))
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+        self.__remove()
+
+    def __remove(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def write(self, data):
+        if self._file is None:
+            return len(data)
+        self._size += len(data)
+        if self._size > self._cache.max_bytes:
+            self.__abandon("larger than {} bytes".format(
+                self._cache.max_bytes))
+            return len(data)
+        # Keep the cache and this file within max_bytes together
+        self._cache.make_room(self._size)
+        try:
+            self._file.write(data)
+        except OSError as e:
+            self.__abandon(e)
+            return len(data)
+        self._sha256.update(data)
+        return len(data)
+
+
+# Lives for as long as the container is warm
+artifact_cache = ArtifactCache()
@@ -0,0 +1,70 @@
+"""Registry of boto3 clients shared by all pipeline_mgr classes.
+
+Clients are created once per container and reused by every object and every
+warm invocation, so their pooled connections are kept. They are configured
+from the environment:
+
+* AWS_ENDPOINT_URL_<SERVICE> overrides the endpoint of a service, e.g.
+  AWS_ENDPOINT_URL_S3=http://localhost:4572 to use a local stand-in
+* PIPELINE_MGR_MAX_ATTEMPTS and PIPELINE_MGR_RETRY_MODE set botocore's
+  retry behaviour
+* PIPELINE_MGR_MAX_POOL_CONNECTIONS sets the size of each connection pool
+"""
+import logging
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger()
+
+_clients = {}
+_lock = threading.Lock()
+_session = None
+
+
+def client_config():
+    retries = {
+        'max_attempts': int(os.environ.get('PIPELINE_MGR_MAX_ATTEMPTS', 5))
+    }
+    # Older botocore releases don't know about retry modes, so the mode is
+    # only passed on when one is asked for
+    if os.environ.get('PIPELINE_MGR_RETRY_MODE'):
+        retries['mode'] = os.environ['PIPELINE_MGR_RETRY_MODE']
+    return Config(
+        retries=retries,
+        max_pool_connections=int(
+            os.environ.get('PIPELINE_MGR_MAX_POOL_CONNECTIONS', 20))
+    )
+
+
+def endpoint_url(service_name):
+    env_name = 'AWS_ENDPOINT_URL_' + service_name.upper().replace('-', '_')
+    return os.environ.get(env_name)
+
+
+def get_client(service_name):
+    """Returns the shared client for service_name, creating it if need be.
+    Clients are thread safe, so may be used from worker threads."""
+    global _session
+    with _lock:
+        if service_name not in _clients:
+            if _session is None:
+                _session = boto3.session.Session()
+            logger.debug("Creating {} client".format(service_name))
+            _clients[service_name] = _session.client(
+                service_name,
+                endpoint_url=endpoint_url(service_name),
+                config=client_config()
+            )
+        return _clients[service_name]
+
+
+def reset():
+    """Drops all clients, the next get_client call builds new ones. Used
+    when the environment they were configured from has changed."""
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
@@ -1,4 +1,5 @@
 import logging
+import os
 
 from pipeline_mgr.pipeline import Pipeline
 from pipeline_mgr.pull_request import PullRequest
@@ -6,18 +7,28 @@ from pipeline_mgr.source import Source
 
 logger = logging.getLogger()
 
+# Version of the dict to_dict() returns. Version 1 dicts included the
+# source and the OAuth token, both are still accepted.
+SCHEMA_VERSION = 2
+
 
 class Manager:
 
     def __init__(self, spec):
         if type(spec) is dict:
+            if spec.get('schema_version', 1) > SCHEMA_VERSION:
+                raise ValueError(
+                    "Manager schema version {} is newer than {}".format(
+                        spec['schema_version'], SCHEMA_VERSION))
             self._bucket_name = spec['bucket_name']
             self._pull_request = (
                 spec['pull_request'] if type(spec['pull_request']) 
                                         is PullRequest 
                 else PullRequest(spec['pull_request'])
             )
-            self._oath_token = spec['oath_token']
+            # The token is kept out of the state passed between steps
+            self._oath_token = (spec.get('oath_token')
+                                or os.environ.get('OAUTH_TOKEN'))
 
             # If pipeline or source spec is included use it to build
             # objects ,otherwise build objects based on provided params
@@ -36,13 +47,11 @@ class Manager:
                 }
                 self._pipeline = Pipeline(pipeline_spec)
 
-            if spec.get('source'):
-                self._source = (
-                    spec['source'] if type(spec['source']) 
-                                            is Source 
-                    else Source(spec['source'])
-                )
+            if type(spec.get('source')) is Source:
+                self._source = spec['source']
             else:
+                # The source is rebuilt from the pull request, which also
+                # covers version 1 dicts
                 src_spec = {
                     'bucket_name': self.bucket_name,
                     'id': self.pull_request.number,
@@ -64,8 +73,7 @@ class Manager:
                                 'bucket_name': self.bucket_name,
                                 'pipeline': self.pipeline,
                                 'pull_request': self.pull_request,
-                                'source': self.source,
-                                'oath_token': self.oath_token
+                                'source': self.source
                             }
                         )
                 + ")"
@@ -121,10 +129,12 @@ class Manager:
         self._oath_token = token
 
     def to_dict(self):
+        """Serializes the manager without any calls to AWS or GitHub. The
+        source is left out as it's rebuilt from the pull request, and the
+        token as it's read from OAUTH_TOKEN."""
         return {
+            'schema_version': SCHEMA_VERSION,
             'bucket_name':  self.bucket_name,
             'pipeline':     self.pipeline.to_dict(),
-            'pull_request': self.pull_request.to_dict(),
-            'source':       self.source.to_dict(),
-            'oath_token':   self.oath_token
+            'pull_request': self.pull_request.to_dict()
         }
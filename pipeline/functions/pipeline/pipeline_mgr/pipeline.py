@@ -1,7 +1,7 @@
 import json
 import logging
 
-import boto3
+from pipeline_mgr.clients import get_client
 from pipeline_mgr.stack import Stack
 
 logger = logging.getLogger()
@@ -14,6 +14,8 @@ class Pipeline:
             self._name = spec.get('name')
             self._execution_id = spec.get('execution_id')
             self._app_stack_name = spec.get('app_stack_name')
+            # Last known status of the execution, see refresh_status()
+            self._status = spec.get('status')
             if spec.get('stack'):
                 self._stack = (
                     spec['stack'] if type(spec['stack']) is Stack
@@ -37,17 +39,21 @@ class Pipeline:
     def app_stack_name(self, name):
         self._app_stack_name = name
 
-    def build(self, source, template_path):
-        """Builds a pipeline with a test and deploy stack"""
-        source.download_from_s3()
-        source.unzip()
-        unzipdir = source.unzip_dir
-        self.stack.apply_template(
-            unzipdir + template_path,
+    def build(self, source, template_path, wait=True):
+        """Builds a pipeline with a test and deploy stack. If wait is False
+        the stack operation is only started, see Stack.check(). Returns the
+        state of the stack, or None if it's busy with an earlier operation,
+        see Stack.apply_template_body().
+
+        Only the template is read from the source archive in S3, nothing is
+        downloaded or extracted."""
+        return self.stack.apply_template_body(
+            source.read_member(template_path),
             parameters={
                 'S3SourceKey': source.s3_path,
                 'AppStackName': self.app_stack_name
-            }
+            },
+            wait=wait
         )
 
     @property
@@ -67,20 +73,36 @@ class Pipeline:
         self._name = pipeline_name
 
     def to_dict(self):
-        return {
+        """Serializes the pipeline without any calls to AWS"""
+        pipeline_dict = {
                 'app_stack_name': self.app_stack_name,
                 'name': self.name,
                 'execution_id': self.execution_id,
-                'status': self.status,
+                'status': self._status,
                 'stack': self.stack.to_dict()
         }
+        return {key: value for key, value in pipeline_dict.items()
+                if value is not None}
 
     def start(self):
-        codepipeline = boto3.client('codepipeline')
+        codepipeline = get_client('codepipeline')
         response = codepipeline.start_pipeline_execution(name=self.name)
         self.execution_id = response['pipelineExecutionId']
+        self._status = None
         return self.execution_id
 
+    def refresh_status(self):
+        """Fetches the status of the execution"""
+        if self.execution_id:
+            codepipeline = get_client('codepipeline')
+            status_response = codepipeline.get_pipeline_execution(
+                pipelineName=self.name,
+                pipelineExecutionId=self.execution_id)
+            self._status = status_response['pipelineExecution']['status']
+        else:
+            self._status = None
+        return self._status
+
     @property
     def stack(self):
         return self._stack
@@ -94,11 +116,7 @@ class Pipeline:
 
     @property
     def status(self):
-        if self.execution_id:
-            codepipeline = boto3.client('codepipeline')
-            status_response = codepipeline.get_pipeline_execution(
-                pipelineName=self.name,
-                pipelineExecutionId=self.execution_id)
-            return status_response['pipelineExecution']['status']
-        else:
-            return None
+        """Status of the execution, only fetched if it isn't known yet"""
+        if self._status is None and self.execution_id:
+            self.refresh_status()
+        return self._status
@@ -0,0 +1,117 @@
+"""Pool of generic pipeline stacks created ahead of time, so that the tests
+of a PR don't wait for a whole pipeline stack to be created.
+
+Each stack has a lease in the state table. A PR claims a free stack with a
+conditional write, so a stack is never leased to two PRs, and the stack is
+retargeted at the PR's source by updating its parameters. The lease is
+released when the PR is closed.
+"""
+import logging
+import os
+
+from pipeline_mgr.stack import Stack
+from pipeline_mgr.state_store import pool_key, pool_pr_key, StateStore
+
+logger = logging.getLogger()
+
+POOL_PREFIX = 'thebestest-pipeline-test-pool-'
+POOL_SIZE = int(os.environ.get('PIPELINE_MGR_POOL_SIZE', 0))
+# Packaged with the Lambda by deploy_pipeline.py
+POOL_TEMPLATE = os.environ.get(
+    'PIPELINE_MGR_POOL_TEMPLATE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 'pipeline_deploy_stack.yaml')
+)
+# Until a stack is claimed its source doesn't exist
+PLACEHOLDER_SOURCE_KEY = 'source/pool-placeholder.zip'
+# A failed update is rolled back to a stack that still works
+USABLE_STATUSES = ('CREATE_COMPLETE', 'UPDATE_COMPLETE',
+                   'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS',
+                   'UPDATE_ROLLBACK_COMPLETE')
+
+
+class Pool:
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        # Without a pool the state table isn't needed
+        self._store = StateStore() if size else None
+
+    def __holder(self, pr_number):
+        return 'pr:{}'.format(pr_number)
+
+    def claim(self, pr_number):
+        """Returns the name of the stack leased to a PR, leasing it a free
+        one if it has none. None if there's no pool or no free stack."""
+        stack_name = self.held_by(pr_number)
+        if stack_name or not self.size:
+            return stack_name
+        for stack_name in self.stack_names:
+            if self._store.acquire_lease(pool_key(stack_name),
+                                         self.__holder(pr_number)):
+                self._store.put(pool_pr_key(pr_number),
+                                {'stack_name': stack_name})
+                logger.info("Leased {} to PR {}".format(stack_name,
+                                                        pr_number))
+                return stack_name
+        logger.info("No free pool stack for PR {}".format(pr_number))
+        return None
+
+    def held_by(self, pr_number):
+        """Returns the name of the stack leased to a PR, or None"""
+        if not self.size:
+            return None
+        lease = self._store.get(pool_pr_key(pr_number))
+        return lease['stack_name'] if lease else None
+
+    def refill(self, template_path=POOL_TEMPLATE):
+        """Starts creating the pool's stacks that don't exist and deleting
+        those that failed to be created, which are created again by a later
+        refill. Stacks that have been created are made available to claim,
+        and those that have failed are made unavailable. Nothing is waited
+        for. Returns the number of stacks available or leased."""
+        with open(template_path) as template_file:
+            template = template_file.read()
+        ready = 0
+        for stack_name in self.stack_names:
+            stack = Stack({'name': stack_name})
+            if stack.status in USABLE_STATUSES:
+                self._store.mark_lease_ready(pool_key(stack_name))
+                ready += 1
+            elif stack.status is None:
+                logger.info("Creating pool stack {}".format(stack_name))
+                stack.apply_template_body(
+                    template,
+                    parameters={
+                        'S3SourceKey': PLACEHOLDER_SOURCE_KEY,
+                        'AppStackName': stack_name.replace('pipeline-', '')
+                    },
+                    wait=False
+                )
+            elif stack.state == 'Failed':
+                self._store.mark_lease_unready(pool_key(stack_name))
+                if stack.status == 'ROLLBACK_COMPLETE':
+                    logger.info("Deleting rolled back pool stack {}".format(
+                        stack_name))
+                    stack.delete(wait=False)
+                else:
+                    logger.warning("Pool stack {} is {}".format(
+                        stack_name, stack.status))
+        logger.info("{} of {} pool stacks ready".format(ready, self.size))
+        return ready
+
+    def release(self, pr_number):
+        """Returns the stack leased to a PR to the pool. Returns False if the
+        PR had no stack."""
+        stack_name = self.held_by(pr_number)
+        if not stack_name:
+            return False
+        self._store.release_lease(pool_key(stack_name),
+                                  self.__holder(pr_number))
+        self._store.claim(pool_pr_key(pr_number))
+        logger.info("Returned {} to the pool".format(stack_name))
+        return True
+
+    @property
+    def stack_names(self):
+        return [POOL_PREFIX + str(index) for index in range(self.size)]
@@ -1,10 +1,17 @@
+import io
 import logging
-import os
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile
 
-import boto3
+from botocore.exceptions import ClientError
 import github3
 
+from pipeline_mgr import archive
+from pipeline_mgr.cache import artifact_cache
+from pipeline_mgr.clients import get_client
+from pipeline_mgr.transfer import (
+    MultipartUploadWriter, open_ranged, TeeWriter
+)
+
 logger = logging.getLogger()
 
 
@@ -18,136 +25,127 @@ class Source:
             self._id = str(spec.get('id'))
             self._sha = spec.get('sha')
             self._bucket_name = spec.get('bucket_name')
-            self._work_path = spec.get('work_path', '/tmp')
         else:
             raise TypeError(
                 "spec is a {} not a dict.".format(type(spec))
             )
 
-        self._unzip_dir = None
-        self._download_path = None
         self._zipball_name = 'thebestest-' + self._id + '.zip'
         self._s3_path = 'source/' + self._zipball_name
-        self._zipball_path = '/tmp/' + self._zipball_name
+        # Repackaged archives are also kept by commit, so a commit is only
+        # retrieved from GitHub once however many times it's tested
+        self._sha_s3_path = 'source/sha/' + str(self._sha) + '.zip'
 
     def __repr__(self):
         return "Source(" + str(self.to_dict()) + ")"
 
-    def download_from_github(self):
-        gh = github3.login(token=self._token)
-        repo = gh.repository(self._repo_owner, self._repo_name)
-        self.download_path = '/tmp/' + self._sha + '.zip'
-        logger.info("Downloading zipball to {}".format(self.download_path))
-        repo.archive('zipball', path=self.download_path, ref=self._sha)
-
-    def download_from_s3(self):
-        s3 = boto3.resource('s3')
-        logger.info("Downloading s3://{}/{} to {}".format(
-            self._bucket_name, self._s3_path, self._zipball_path))
-        s3.meta.client.download_file(self._bucket_name,
-                                     self._s3_path,
-                                     self._zipball_path)
-        self.download_path = self._zipball_path
-
     @property
-    def download_path(self):
-        return self._download_path
+    def cache_key(self):
+        """Key of the repackaged archive in the artifact cache"""
+        return (self._bucket_name, self._s3_path, self._sha)
 
-    @download_path.setter
-    def download_path(self, path):
-        self._download_path = path
+    def download_from_github(self, fileobj):
+        """Downloads the zipball of the commit into fileobj"""
+        gh = github3.login(token=self._token)
+        repo = gh.repository(self._repo_owner, self._repo_name)
+        logger.info("Downloading zipball of {}".format(self._sha))
+        repo.archive('zipball', path=fileobj, ref=self._sha)
 
-    def repackage_archive(self):
-        """Repackages a zipball retrieved from Github to be as expected by
-        codepipeline.
+    def read_member(self, name):
+        """Returns a file in the zipball in S3 as text. Only the zip's
+        central directory and the file itself are fetched, by ranged GETs,
+        and nothing at all if the zipball is in the artifact cache.
         """
-        logger.info("Repackaging {} to {}".format(
-            self.download_path, self._zipball_path))
-        self.unzip()
-        self.zip()
+        cached_path = artifact_cache.get(self.cache_key)
+        if cached_path:
+            with ZipFile(cached_path) as src_zip:
+                return src_zip.read(name).decode()
+        logger.info("Reading {} from s3://{}/{}".format(
+            name, self._bucket_name, self._s3_path))
+        with open_ranged(self._bucket_name, self._s3_path) as zipball, \
+                ZipFile(zipball) as src_zip:
+            return src_zip.read(name).decode()
+
+    def __copy_from_sha_cache(self):
+        """Copies the archive of the commit, if it was retrieved before, to
+        s3_path within S3. Returns the Version ID of the copy or None if the
+        commit isn't cached."""
+        s3 = get_client('s3')
+        try:
+            head = s3.head_object(Bucket=self._bucket_name,
+                                  Key=self._sha_s3_path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                logger.info("Source cache miss for {}".format(self._sha))
+                return None
+            raise
+        # The digest is only recorded once the archive is complete
+        if 'sha256' not in head.get('Metadata', {}):
+            logger.info("Source cache miss for {}, no digest".format(
+                self._sha))
+            return None
+        logger.info("Source cache hit for {}, copying s3://{}/{} to "
+                    "{}".format(self._sha, self._bucket_name,
+                                self._sha_s3_path, self._s3_path))
+        response = s3.copy_object(
+            Bucket=self._bucket_name,
+            Key=self._s3_path,
+            CopySource={'Bucket': self._bucket_name,
+                        'Key': self._sha_s3_path},
+            MetadataDirective='COPY'
+        )
+        return response.get('VersionId', 'null')
+
+    def __store_in_sha_cache(self, hexdigest):
+        """Copies the archive at s3_path to the commit's key, recording its
+        digest in the object's metadata."""
+        s3 = get_client('s3')
+        logger.info("Caching s3://{}/{} as {}".format(
+            self._bucket_name, self._s3_path, self._sha_s3_path))
+        s3.copy_object(
+            Bucket=self._bucket_name,
+            Key=self._sha_s3_path,
+            CopySource={'Bucket': self._bucket_name, 'Key': self._s3_path},
+            Metadata={'sha256': hexdigest, 'commit': str(self._sha)},
+            MetadataDirective='REPLACE'
+        )
 
     def retrieve_source(self):
-        self.download_from_github()
-        self.repackage_archive()
-        self.upload_to_s3()
+        """Streams the zipball from GitHub through the repackager into a
+        multipart upload to S3. A zip archive is read from its end, so the
+        zipball is held in memory. Only the repackaged archive is written to
+        /tmp, for the artifact cache.
+
+        If the commit was retrieved before, its archive is copied within S3
+        instead."""
+        version_id = self.__copy_from_sha_cache()
+        if version_id:
+            logger.info("Copy has Version ID {}".format(version_id))
+            return version_id
+
+        zipball = io.BytesIO()
+        self.download_from_github(zipball)
+        logger.info("Repackaging zipball to s3://{}/{}".format(
+            self._bucket_name, self._s3_path))
+        # Also kept in /tmp, BuildPipeline usually runs on the same container
+        with artifact_cache.writer(self.cache_key) as cached, \
+                MultipartUploadWriter(self._bucket_name,
+                                      self._s3_path) as upload:
+            archive.repackage(zipball, TeeWriter(upload, cached))
+        logger.info("Upload has Version ID {}".format(upload.version_id))
+        self.__store_in_sha_cache(upload.hexdigest())
+        return upload.version_id
 
     @property
     def s3_path(self):
         return self._s3_path
 
     def to_dict(self):
+        """Everything needed to rebuild the source, bar the token"""
         return {
                     'bucket_name': self._bucket_name,
                     'id': self._id,
                     'repo_owner': self._repo_owner,
                     'repo_name': self._repo_name,
-                    's3_path': self._s3_path,
-                    'sha': self._sha,
-                    'token': self._token
+                    'sha': self._sha
                 }
-
-    def unzip(self):
-        with ZipFile(self.download_path) as src_zip:
-            zip_info = src_zip.infolist()
-            # check to see if the zipball has a dir at the root as it would
-            # from Github, or if files are at the root as it would after it's
-            # been repacked or downloaded from S3.
-            first_file_in_zip = zip_info[0].filename
-            if first_file_in_zip.endswith('/'):
-                unzip_root = self._work_path
-                self.unzip_dir = self._work_path + '/' + first_file_in_zip
-            else:
-                unzip_root= (
-                    self._work_path + '/' + 'thebestest-' + self._id + '/'
-                )
-                self.unzip_dir = unzip_root
-                try:
-                    os.mkdir(unzip_root)
-                except FileExistsError:
-                    logging.debug("{} exists".format(unzip_root))
-            logger.debug("unzip_dir set to {}".format(self.unzip_dir))
-            logger.info("unzipping {} to {}".format(self.download_path,
-                                                    unzip_root))
-            src_zip.extractall(path=unzip_root)
-            logger.debug(os.listdir(unzip_root))
-
-    @property
-    def unzip_dir(self):
-        return self._unzip_dir
-
-    @unzip_dir.setter
-    def unzip_dir(self, path):
-        self._unzip_dir = path
-
-    def upload_to_s3(self):
-        s3 = boto3.client('s3')
-        logger.info("Uploading {} to s3://{}/{}".format(
-            self._zipball_path, self._bucket_name, self._s3_path))
-        with open(self._zipball_path, 'rb') as zipball:
-            response = s3.put_object(Bucket=self._bucket_name,
-                                     Key=self._s3_path,
-                                     Body=zipball)
-        version_id = response['VersionId']
-        logger.info("Upload has Version ID {}".format(version_id))
-        logger.info("Removing {}".format(self.download_path))
-        os.remove(self.download_path)
-        logger.info("Removing {}".format(self._zipball_path))
-        os.remove(self._zipball_path)
-        return version_id
-
-    def zip(self):
-        logger.info("zipping {} into {}".format(self.unzip_dir,
-                                                self._zipball_path))
-        with ZipFile(self._zipball_path, mode='w',
-                     compression=ZIP_DEFLATED) as dest_zip:
-            for root, dirs, files in os.walk(self.unzip_dir):
-                for file in files:
-                    src_path = os.path.join(root, file)
-                    arc_path = src_path.replace(self.unzip_dir, '')
-                    logger.debug(
-                        "zipping file {} to {}:{}".format(
-                            src_path, self._zipball_path, arc_path
-                        )
-                    )
-                    dest_zip.write(src_path, arcname=arc_path)
-            logger.debug(dest_zip.infolist())
@@ -1,19 +1,62 @@
-from hashlib import sha1
+from hashlib import sha256
+import json
 import logging
+import os
+import time
 
-import boto3
-from botocore.exceptions import ClientError, WaiterError
+from botocore.exceptions import ClientError
+
+from pipeline_mgr.clients import get_client
 
 logger = logging.getLogger()
 
+# Status a stack ends up in when each operation succeeds
+SUCCESS_STATUS = {
+    'create': 'CREATE_COMPLETE',
+    'update': 'UPDATE_COMPLETE',
+    'delete': 'DELETE_COMPLETE'
+}
+WAIT_MIN_DELAY = 2
+WAIT_MAX_DELAY = 15
+# Tag holding the digest of the template and parameters a stack was last
+# created or updated with, see template_digest()
+DIGEST_TAG = 'thebestest:template-digest'
+# Largest template that can be passed as TemplateBody
+TEMPLATE_BODY_LIMIT = 51200
+TEMPLATE_PREFIX = 'templates/'
+# Templates staged by this container, by the SHA-256 of their body. Each has
+# the args passing it to CFN and whether it's been validated.
+_templates = {}
+
+
+def template_digest(template, parameters=None):
+    """Digest of a template and its parameters. Line endings and trailing
+    whitespace don't change the digest, nor does the order of parameters.
+    """
+    lines = template.replace('\r\n', '\n').rstrip().split('\n')
+    normalized = '\n'.join(line.rstrip() for line in lines) + '\n'
+    params = sorted((parameters or {}).items())
+    return sha256(
+        json.dumps([normalized, params]).encode()).hexdigest()
+
 
 class Stack:
 
     def __init__(self, spec):
         self._name = spec.get('name')
         self._arn = spec.get('arn')
-        self._hexdigest = spec.get('hexdigest')
-        self.cfn = boto3.client('cloudformation')
+        # Id of the newest stack event already logged
+        self._last_event_id = spec.get('last_event_id')
+        # Total seconds to wait for a stack operation to finish
+        self.wait_budget = int(
+            spec.get('wait_budget', os.environ.get('STACK_WAIT_BUDGET', 180)))
+        # Snapshot of describe_stacks, {} if the stack doesn't exist and None
+        # until it's first needed. Stack operations discard it.
+        self._description = None
+        # Templates are uploaded here and passed to CFN as a TemplateURL
+        self.template_bucket = spec.get('template_bucket',
+                                        os.environ.get('S3_BUCKET'))
+        self.cfn = get_client('cloudformation')
 
     def __repr__(self):
         return "Stack(" + str(self.to_dict()) + ")"
@@ -21,46 +64,206 @@ class Stack:
     def __str__(self):
         return str(self.to_dict())
 
-    def __cfn_wait(self, condition):
-        create_waiter = self.cfn.get_waiter(condition)
-        waiter_delay = 10
-        waiter_max_attempts = 18
-        logger.info("Waiting up to {} seconds for {}.".format(
-            str(waiter_delay * waiter_max_attempts),
-            condition
-        ))
-        try:
-            create_waiter.wait(StackName=self.arn,
-                               WaiterConfig={
-                                   'Delay': waiter_delay,
-                                   'MaxAttempts': waiter_max_attempts
-                               }
-                               )
-        except WaiterError:
-            events_response = self.cfn.describe_stack_events(
-                StackName=self.name)
-            for event in events_response['StackEvents']:
-                if event['ResourceStatus'] == 'CREATE_FAILED':
-                    logger.error(event['ResourceStatusReason'])
+    def __cfn_wait(self, operation):
+        """Waits for a create, update or delete to finish, logging stack
+        events as they happen. Polls quickly at first and backs off as the
+        operation drags on, returning as soon as the stack settles."""
+        deadline = time.time() + self.wait_budget
+        delay = WAIT_MIN_DELAY
+        failure_reasons = []
+        logger.info("Waiting up to {} seconds for {} of stack {}.".format(
+            self.wait_budget, operation, self.name))
+        while True:
+            failure_reasons.extend(self.__log_new_events())
+            status = self.refresh().get('StackStatus')
+            if self.__operation_done(operation, status):
+                break
+            if time.time() + delay > deadline:
+                raise RuntimeError(
+                    "Timed out after {} seconds waiting for {} of stack {}, "
+                    "status is {}".format(self.wait_budget, operation,
+                                          self.name, status))
+            time.sleep(delay)
+            delay = min(delay * 1.5, WAIT_MAX_DELAY)
+
+        # A deleted stack can no longer be found by name
+        if operation == 'delete' and status is None:
+            return
+        if status != SUCCESS_STATUS[operation] and not (
+                status == 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'):
             raise RuntimeError(
-                "Stack failed to create with status {}".format(
-                    self.status))
+                "Stack {} failed to {} with status {}: {}".format(
+                    self.name, operation, status,
+                    failure_reasons[0] if failure_reasons else 'unknown'))
+
+    def __template_args(self, template):
+        """Returns the args passing template to CFN and whether it's been
+        validated. The template is uploaded to the template bucket under
+        the hash of its body, unless it's already there, and passed as a
+        TemplateURL. With no bucket it's passed as a TemplateBody."""
+        body = template.encode()
+        body_digest = sha256(body).hexdigest()
+        staged = _templates.get(body_digest)
+        if staged:
+            return staged
+        if not self.template_bucket:
+            if len(body) > TEMPLATE_BODY_LIMIT:
+                raise ValueError(
+                    "Template is {} bytes, over the {} byte limit of a "
+                    "TemplateBody, and no template bucket is set".format(
+                        len(body), TEMPLATE_BODY_LIMIT))
+            staged = {'args': {'TemplateBody': template},
+                      'validated': False}
+            _templates[body_digest] = staged
+            return staged
+
+        s3 = get_client('s3')
+        key = TEMPLATE_PREFIX + body_digest + '.yaml'
+        try:
+            head = s3.head_object(Bucket=self.template_bucket, Key=key)
+            validated = head.get('Metadata', {}).get('validated') == 'true'
+            logger.info("Reusing template s3://{}/{}".format(
+                self.template_bucket, key))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            logger.info("Uploading template to s3://{}/{}".format(
+                self.template_bucket, key))
+            s3.put_object(Bucket=self.template_bucket, Key=key, Body=body)
+            validated = False
+        url = 'https://{}.s3.{}.amazonaws.com/{}'.format(
+            self.template_bucket, self.cfn.meta.region_name, key)
+        staged = {'args': {'TemplateURL': url},
+                  'key': key,
+                  'validated': validated}
+        _templates[body_digest] = staged
+        return staged
+
+    def __validate(self, template):
+        """Validates a template, unless the same template has already been
+        validated, which is recorded in its object's metadata."""
+        staged = self.__template_args(template)
+        if staged['validated']:
+            logger.info("CFN template for {} already validated".format(
+                self.name))
+            return
+        logger.info("Validating CFN template for {}".format(self.name))
+        self.cfn.validate_template(**staged['args'])
+        staged['validated'] = True
+        if staged.get('key'):
+            get_client('s3').copy_object(
+                Bucket=self.template_bucket,
+                Key=staged['key'],
+                CopySource={'Bucket': self.template_bucket,
+                            'Key': staged['key']},
+                Metadata={'validated': 'true'},
+                MetadataDirective='REPLACE'
+            )
+
+    def __log_new_events(self):
+        """Logs events since the last one seen, returning the reasons given
+        for any failures"""
+        failure_reasons = []
+        for event in self.__new_events():
+            reason = event.get('ResourceStatusReason', '')
+            if event['ResourceStatus'].endswith('_FAILED'):
+                logger.error("{} {}: {}".format(event['LogicalResourceId'],
+                                                event['ResourceStatus'],
+                                                reason))
+                failure_reasons.append(reason)
+            else:
+                logger.info("{} {} {}".format(event['LogicalResourceId'],
+                                              event['ResourceStatus'],
+                                              reason))
+        return failure_reasons
+
+    def __mark_events(self):
+        """Remembers the newest event so only events of the operation about
+        to start are logged"""
+        try:
+            response = self.cfn.describe_stack_events(
+                StackName=self._arn or self.name)
+        except ClientError as e:
+            if "does not exist" in e.response['Error']['Message']:
+                self._last_event_id = None
+                return
+            raise
+        events = response['StackEvents']
+        self._last_event_id = events[0]['EventId'] if events else None
+
+    def __new_events(self):
+        """Returns the events since the last one seen, oldest first. Events
+        are listed newest first, so pages are only read until a seen event
+        turns up."""
+        paginator = self.cfn.get_paginator('describe_stack_events')
+        events = []
+        try:
+            for page in paginator.paginate(StackName=self._arn or self.name):
+                for event in page['StackEvents']:
+                    if event['EventId'] == self._last_event_id:
+                        break
+                    events.append(event)
+                else:
+                    continue
+                break
+        except ClientError as e:
+            if "does not exist" in e.response['Error']['Message']:
+                return []
+            raise
+        if events:
+            self._last_event_id = events[0]['EventId']
+        return list(reversed(events))
+
+    @staticmethod
+    def __operation_done(operation, status):
+        if status is None:
+            # Gone, or not created yet
+            return operation == 'delete'
+        if operation == 'update' and status == (
+                'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'):
+            # Old resources are being removed, the update itself is done
+            return True
+        return not status.endswith('_IN_PROGRESS')
 
-    def apply_template(self, template_path, parameters=None):
+    def apply_template(self, template_path, parameters=None, wait=True):
+        """applies a cfn template file to stack, see apply_template_body()"""
+        with open(template_path) as template_file:
+            template = template_file.read()
+        logger.info("Applying CFN template {}".format(template_path))
+        return self.apply_template_body(template, parameters, wait)
+
+    def apply_template_body(self, template, parameters=None, wait=True):
         """applies a cfn template to stack, this may create the stack from
-        scratch or update an existing stack"""
-        # Check if stack already exists, if rolled back, then delete stack
+        scratch or update an existing stack. If wait is False the create or
+        update is only started, check() tells when it's done.
+
+        Returns the state of the stack, see state, or None without applying
+        anything if an operation on the stack is still in progress, CFN
+        rejects any update until it's done. A stack that's already up to
+        date has Succeeded, even if its last update was rolled back to it.
+        """
+        # Check if stack already exists, if rolled back, then delete stack.
+        # This always waits, as the stack can't be created until it's gone.
         if self.status == 'ROLLBACK_COMPLETE':
             logger.info(
                 "CFN stack {} in a ROLLBACK_COMPLETE state.".format(self.name)
             )
             self.delete()
 
-        with open(template_path) as template_file:
-            template = template_file.read()
+        if self.status and self.status.endswith('_IN_PROGRESS'):
+            logger.info("CFN stack {} is {}, not applying yet.".format(
+                self.name, self.status))
+            return None
+
+        # The digest covers the parameters too, so a new S3SourceKey alone
+        # still updates the stack. It's compared with the stack's tag, which
+        # comes with the same describe_stacks as its status.
+        hexdigest = template_digest(template, parameters)
+        if self.status and hexdigest == self.hexdigest:
+            logger.info("CFN stack {} already up-to-date.".format(self.name))
+            return 'Succeeded'
 
-        logger.info("Validating CFN template {}".format(template_path))
-        self.cfn.validate_template(TemplateBody=template)
+        self.__validate(template)
         if parameters:
             cfn_params = [
                 {'ParameterKey': key,
@@ -68,39 +271,33 @@ class Stack:
                 for key in parameters]
         else:
             cfn_params = []
-        # See if create from scratch or update
-        # add new line to end of file if one doesn't exist
-        if not template.endswith('\n'):
-            template = template + '\n'
-        hexdigest = sha1(template.encode()).hexdigest()
-        if self.hexdigest is None:
-            self.create(template, cfn_params)
-        elif hexdigest != self.hexdigest:
-            self.update(template, cfn_params)
+        tags = [{'Key': DIGEST_TAG, 'Value': hexdigest}]
+        # See if create from scratch or update. A stack without the tag
+        # predates it, so is updated.
+        if not self.status:
+            self.create(template, cfn_params, wait, tags)
         else:
-            logger.info("CFN stack {} already up-to-date.".format(self.name))
+            self.update(template, cfn_params, wait, tags)
+        return self.state
 
     @property
     def arn(self):
-        if self.status:
-            if not self._arn:
-                try:
-                    response = self.cfn.describe_stacks(StackName=self.name)
-                except ClientError as e:
-                    if "does not exist" in e.response['Error']['Message']:
-                        return None
-                    else:
-                        raise
-                self._arn = response['Stacks'][0]['StackId']
-        else:
-            self._arn = None
+        if self._arn is None:
+            self._arn = self.describe().get('StackId')
         return self._arn
 
     @arn.setter
     def arn(self, arn):
         self._arn = arn
 
-    def create(self, template, param_list=None):
+    def check(self):
+        """Takes a new snapshot of the stack, logs any events since the last
+        check and returns the state of the stack's last operation."""
+        self.refresh()
+        self.__log_new_events()
+        return self.state
+
+    def create(self, template, param_list=None, wait=True, tags=None):
             logger.info(
                 "Creating CFN stack {} with Params {}".format(
                     self.name,
@@ -109,37 +306,49 @@ class Stack:
             )
             response = self.cfn.create_stack(
                 StackName=self.name,
-                TemplateBody=template,
                 Capabilities=['CAPABILITY_IAM'],
-                Parameters=param_list
+                Parameters=param_list,
+                Tags=tags or [],
+                **self.__template_args(template)['args']
             )
 
-            arn = response['StackId']
-            logger.info("StackId {}".format(arn))
-            self.__cfn_wait('stack_create_complete')
-            logger.info("Stack {} created".format(self.name))
+            self._description = None
+            self._arn = response['StackId']
+            # A new stack, so all of its events are new
+            self._last_event_id = None
+            logger.info("StackId {}".format(self._arn))
+            if wait:
+                self.__cfn_wait('create')
+                logger.info("Stack {} created".format(self.name))
 
-    def delete(self):
+    def delete(self, wait=True):
         arn = self.arn
         logger.info("Deleting stack with ARN {}".format(arn))
+        self.__mark_events()
         self.cfn.delete_stack(StackName=arn)
-        self.__cfn_wait('stack_delete_complete')
+        self._description = None
+        if not wait:
+            return
+        self.__cfn_wait('delete')
+        self._arn = None
+        self._description = None
         logger.info("Stack {} deleted".format(self.name))
 
+    def describe(self):
+        """Returns the stack's description as of the last refresh, taking
+        one if there isn't one yet. Returns {} if the stack doesn't exist."""
+        if self._description is None:
+            self.refresh()
+        return self._description
+
     @property
     def hexdigest(self):
-        if self.status:
-            if not self._hexdigest:
-                cfn_response = self.cfn.get_template(StackName=self.arn)
-                stack_template = cfn_response['TemplateBody']
-                self._hexdigest = sha1(stack_template.encode()).hexdigest()
-            return self._hexdigest
-        else:
-            return None
-
-    @hexdigest.setter
-    def hexdigest(self, digest):
-        self._hexdigest = digest
+        """Digest the stack was last created or updated with, from its tag.
+        None if the stack doesn't exist or isn't tagged."""
+        for tag in self.describe().get('Tags', []):
+            if tag['Key'] == DIGEST_TAG:
+                return tag['Value']
+        return None
 
     @property
     def name(self):
@@ -149,37 +358,69 @@ class Stack:
     def name(self, name):
         self._name = name
 
-    @property
-    def status(self):
+    def refresh(self):
+        """Takes a new snapshot of the stack's description, this is the only
+        place describe_stacks is called."""
         try:
             response = self.cfn.describe_stacks(StackName=self.name)
         except ClientError as e:
             if "does not exist" in e.response['Error']['Message']:
-                return None
+                self._description = {}
+                return self._description
             else:
                 raise
-        return response['Stacks'][0]['StackStatus']
+        self._description = response['Stacks'][0]
+        return self._description
+
+    @property
+    def state(self):
+        """Coarse state of the stack's last operation: InProgress, Succeeded
+        or Failed, in line with the statuses of a pipeline execution."""
+        status = self.status
+        if status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE',
+                      'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'):
+            return 'Succeeded'
+        elif status and status.endswith('_IN_PROGRESS'):
+            return 'InProgress'
+        else:
+            return 'Failed'
+
+    @property
+    def status(self):
+        return self.describe().get('StackStatus')
 
     def to_dict(self):
-        return {
-                'arn': self.arn,
-                'hexdigest': self.hexdigest,
+        """Serializes the stack without any calls to CFN. The status is only
+        included if it was already fetched, for information."""
+        stack_dict = {
+                'arn': self._arn,
+                'last_event_id': self._last_event_id,
                 'name': self.name,
-                'status': self.status
+                'status': (self._description.get('StackStatus')
+                           if self._description is not None else None)
         }
+        if self.template_bucket != os.environ.get('S3_BUCKET'):
+            stack_dict['template_bucket'] = self.template_bucket
+        return {key: value for key, value in stack_dict.items()
+                if value is not None}
 
-    def update(self, template, param_list=None):
+    def update(self, template, param_list=None, wait=True, tags=None):
         logger.info(
             "Updating CFN stack {} with Params {}".format(
                 self.name,
                 param_list
             )
         )
+        self.__mark_events()
         self.cfn.update_stack(
             StackName=self.name,
-            TemplateBody=template,
             Capabilities=['CAPABILITY_IAM'],
-            Parameters=param_list
+            Parameters=param_list,
+            Tags=tags or [],
+            **self.__template_args(template)['args']
         )
-        self.__cfn_wait('stack_update_complete')
-        logger.info("Stack {} updated".format(self.name))
+        self._description = None
+        if wait:
+            self.__cfn_wait('update')
+            self._description = None
+            logger.info("Stack {} updated".format(self.name))
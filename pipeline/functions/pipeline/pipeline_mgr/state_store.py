@@ -0,0 +1,170 @@
+"""State the pipeline manager keeps outside of a Step Functions execution, in
+the PipelineMgrStateTable DynamoDB table.
+
+Each item has a string id, made by one of the *_key() functions, and a JSON
+encoded state. Items given a ttl are removed by DynamoDB some time after it's
+passed, until then they're read as if they had already gone.
+
+Lease items instead have a ready flag and the holder of the lease, if any,
+as top level attributes so they can be claimed with conditional writes.
+"""
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from pipeline_mgr.clients import get_client
+
+logger = logging.getLogger()
+
+# Latest execution of each test pipeline as of the last poll
+POLLER_KEY = 'poller:latest-executions'
+
+
+def execution_key(pipeline_name, execution_id):
+    """Id of the task token of a Step Functions execution waiting for a
+    pipeline execution to finish."""
+    return 'execution:{}:{}'.format(pipeline_name, execution_id)
+
+
+def pipeline_key(pipeline_name):
+    """Id of the pull request a test pipeline was last started for"""
+    return 'pipeline:{}'.format(pipeline_name)
+
+
+def pool_key(stack_name):
+    """Id of the lease on a pool stack"""
+    return 'pool:{}'.format(stack_name)
+
+
+def pool_pr_key(pr_number):
+    """Id of the pool stack leased to a pull request"""
+    return 'pool-pr:{}'.format(pr_number)
+
+
+def pr_key(pr_number):
+    """Id of the latest head SHA of a pull request and the execution started
+    for it."""
+    return 'pr:{}'.format(pr_number)
+
+
+def status_key(pipeline_name, execution_id):
+    """Id of the status last set on a pull request for a pipeline execution
+    """
+    return 'status:{}:{}'.format(pipeline_name, execution_id)
+
+
+def item_state(item):
+    """Returns the state of an item, or None if there's no item or it has
+    expired"""
+    if not item:
+        return None
+    if 'expires' in item and int(item['expires']['N']) <= time.time():
+        return None
+    return json.loads(item['state']['S'])
+
+
+class StateStore:
+
+    def __init__(self, table_name=None):
+        self.table_name = (table_name
+                           or os.environ['PIPELINE_MGR_STATE_TABLE'])
+        self.dynamodb = get_client('dynamodb')
+
+    def acquire_lease(self, item_id, holder):
+        """Takes a ready lease for holder. Returns False if the lease isn't
+        ready or someone else holds it."""
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'id': {'S': item_id}},
+                UpdateExpression='SET holder = :holder',
+                ConditionExpression=('attribute_exists(ready) AND '
+                                     '(attribute_not_exists(holder) OR '
+                                     'holder = :holder)'),
+                ExpressionAttributeValues={':holder': {'S': holder}}
+            )
+        except ClientError as e:
+            if (e.response['Error']['Code']
+                    == 'ConditionalCheckFailedException'):
+                return False
+            raise
+        return True
+
+    def claim(self, item_id):
+        """Deletes an item and returns its state, or None if there was no
+        item. Only one of any number of concurrent callers gets the state.
+        """
+        response = self.dynamodb.delete_item(
+            TableName=self.table_name,
+            Key={'id': {'S': item_id}},
+            ReturnValues='ALL_OLD'
+        )
+        return item_state(response.get('Attributes'))
+
+    def get(self, item_id):
+        """Returns the state of an item, or None if there's no item"""
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={'id': {'S': item_id}},
+            ConsistentRead=True
+        )
+        return item_state(response.get('Item'))
+
+    def mark_lease_ready(self, item_id):
+        """Creates a lease, if need be, and makes it available"""
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'id': {'S': item_id}},
+            UpdateExpression='SET ready = :ready',
+            ExpressionAttributeValues={':ready': {'BOOL': True}}
+        )
+
+    def mark_lease_unready(self, item_id):
+        """Stops a lease from being acquired, it's kept by its holder if
+        it has one."""
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'id': {'S': item_id}},
+                UpdateExpression='REMOVE ready',
+                ConditionExpression='attribute_exists(ready)'
+            )
+        except ClientError as e:
+            if (e.response['Error']['Code']
+                    != 'ConditionalCheckFailedException'):
+                raise
+
+    def put(self, item_id, state, ttl=None):
+        """Saves the state of an item, ttl is in seconds. Returns the state
+        it replaced, or None if there was no item."""
+        item = {
+            'id': {'S': item_id},
+            'state': {'S': json.dumps(state)}
+        }
+        if ttl:
+            item['expires'] = {'N': str(int(time.time()) + ttl)}
+        logger.debug("Saving state of {}".format(item_id))
+        response = self.dynamodb.put_item(TableName=self.table_name,
+                                          Item=item,
+                                          ReturnValues='ALL_OLD')
+        return item_state(response.get('Attributes'))
+
+    def release_lease(self, item_id, holder):
+        """Gives up a lease. Returns False if holder didn't hold it."""
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'id': {'S': item_id}},
+                UpdateExpression='REMOVE holder',
+                ConditionExpression='holder = :holder',
+                ExpressionAttributeValues={':holder': {'S': holder}}
+            )
+        except ClientError as e:
+            if (e.response['Error']['Code']
+                    == 'ConditionalCheckFailedException'):
+                return False
+            raise
+        return True
@@ -0,0 +1,225 @@
+"""S3 transfers tuned for moving source archives around without staging them
+on disk first."""
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline_mgr.clients import get_client
+
+logger = logging.getLogger()
+
+MB = 1024 * 1024
+# S3 parts must be at least 5MB, bar the last one
+PART_SIZE = int(os.environ.get('PIPELINE_MGR_PART_SIZE', 8 * MB))
+MAX_CONCURRENCY = int(os.environ.get('PIPELINE_MGR_TRANSFER_CONCURRENCY', 4))
+# Smallest ranged GET made when reading bits of an object
+RANGE_SIZE = int(os.environ.get('PIPELINE_MGR_RANGE_SIZE', 64 * 1024))
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """Write only file object that uploads whatever is written to it to S3
+    as a multipart upload. Parts are uploaded on a thread pool as soon as
+    they fill up, with at most max_concurrency parts held in memory.
+
+    Used as a context manager the upload is completed on a clean exit and
+    aborted if an exception was raised. hexdigest() returns the SHA-256 of
+    everything written.
+    """
+
+    def __init__(self, bucket_name, key, part_size=PART_SIZE,
+                 max_concurrency=MAX_CONCURRENCY, **upload_args):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.version_id = None
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._max_pending = max_concurrency
+        self._parts = []
+        self._position = 0
+        self._sha256 = hashlib.sha256()
+        self._s3 = get_client('s3')
+        response = self._s3.create_multipart_upload(Bucket=bucket_name,
+                                                    Key=key,
+                                                    **upload_args)
+        self._upload_id = response['UploadId']
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def __submit_part(self, data):
+        # Hold back the writer rather than buffering without bound
+        pending = [part for part in self._parts if not part.done()]
+        if len(pending) >= self._max_pending:
+            pending[0].result()
+        part_number = len(self._parts) + 1
+        self._parts.append(
+            self._executor.submit(self.__upload_part, part_number, data))
+
+    def __upload_part(self, part_number, data):
+        response = self._s3.upload_part(Bucket=self.bucket_name,
+                                        Key=self.key,
+                                        UploadId=self._upload_id,
+                                        PartNumber=part_number,
+                                        Body=data)
+        logger.debug("Uploaded part {} of s3://{}/{}".format(
+            part_number, self.bucket_name, self.key))
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def abort(self):
+        if self.closed:
+            return
+        logger.info("Aborting upload to s3://{}/{}".format(self.bucket_name,
+                                                           self.key))
+        self._executor.shutdown(wait=True)
+        self._s3.abort_multipart_upload(Bucket=self.bucket_name,
+                                        Key=self.key,
+                                        UploadId=self._upload_id)
+        super().close()
+
+    def close(self):
+        """Uploads what's left and completes the upload"""
+        if self.closed:
+            return
+        try:
+            # An empty object still needs one part
+            if self._buffer or not self._parts:
+                self.__submit_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            parts = [part.result() for part in self._parts]
+            response = self._s3.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        self._executor.shutdown(wait=True)
+        self.version_id = response.get('VersionId')
+        logger.info("Uploaded {} bytes in {} parts to s3://{}/{}".format(
+            self._position, len(parts), self.bucket_name, self.key))
+        super().close()
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def tell(self):
+        return self._position
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        self._sha256.update(data)
+        while len(self._buffer) >= self.part_size:
+            self.__submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+
+class S3RangeReader(io.RawIOBase):
+    """Read only, seekable file object over an S3 object, each read is a
+    ranged GET. Wrap it in open_ranged() to read in RANGE_SIZE blocks,
+    zipfile makes many small reads.
+
+    Reading a member of a zip archive this way only fetches the end of
+    central directory record, the central directory and the member.
+    """
+
+    def __init__(self, bucket_name, key, version_id=None):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.bytes_read = 0
+        self.requests = 0
+        self._position = 0
+        self._s3 = get_client('s3')
+        self._version_args = {'VersionId': version_id} if version_id else {}
+        response = self._s3.head_object(Bucket=bucket_name, Key=key,
+                                        **self._version_args)
+        self.size = response['ContentLength']
+        # Later reads are pinned to the version headed, in case the key is
+        # written to while it's being read
+        if response.get('VersionId', 'null') != 'null':
+            self._version_args = {'VersionId': response['VersionId']}
+
+    def close(self):
+        if not self.closed:
+            logger.info("Read {} of {} bytes of s3://{}/{} in {} "
+                        "requests".format(self.bytes_read, self.size,
+                                          self.bucket_name, self.key,
+                                          self.requests))
+        super().close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), self.size)
+        if end <= self._position:
+            return 0
+        response = self._s3.get_object(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            Range='bytes={}-{}'.format(self._position, end - 1),
+            **self._version_args)
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self._position += len(data)
+        self.bytes_read += len(data)
+        self.requests += 1
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("negative seek position {}".format(position))
+        self._position = position
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+
+def open_ranged(bucket_name, key, version_id=None):
+    """Opens an S3 object for buffered, seekable reading by ranged GETs"""
+    return io.BufferedReader(S3RangeReader(bucket_name, key, version_id),
+                             buffer_size=RANGE_SIZE)
+
+
+class TeeWriter(io.RawIOBase):
+    """Write only file object that passes whatever is written to it on to
+    each of outputs."""
+
+    def __init__(self, *outputs):
+        self._outputs = outputs
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        for output in self._outputs:
+            output.write(data)
+        self._position += len(data)
+        return len(data)
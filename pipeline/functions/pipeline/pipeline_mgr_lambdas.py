@@ -1,18 +1,45 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
 import os
 
 import boto3
+from botocore.exceptions import ClientError
 
+from pipeline_mgr.clients import get_client
 from pipeline_mgr.manager import Manager
 from pipeline_mgr.pull_request import PullRequest
 from pipeline_mgr.pipeline import Pipeline
+from pipeline_mgr.pool import Pool
 from pipeline_mgr.stack import Stack
 from pipeline_mgr.source import Source
+from pipeline_mgr.state_store import (
+    execution_key, pipeline_key, POLLER_KEY, pr_key, StateStore, status_key
+)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Statuses of a finished pipeline execution, by the state given in its
+# CodePipeline Pipeline Execution State Change event
+FINISHED_STATES = {
+    'FAILED': 'Failed',
+    'STOPPED': 'Stopped',
+    'SUCCEEDED': 'Succeeded',
+    'SUPERSEDED': 'Superseded'
+}
+# Task tokens are dropped a while after the AwaitTest state times out
+TASK_TOKEN_TTL = 2 * 60 * 60
+# How long the pull request a pipeline was started for is kept
+PIPELINE_PR_TTL = 14 * 24 * 60 * 60
+TEST_PIPELINE_PREFIX = 'thebestest-pipeline-test-'
+# Webhook actions the state machine acts on, anything else is dropped
+RELEVANT_ACTIONS = ('opened', 'synchronize', 'closed')
+# How long the latest head SHA of a PR is kept
+PR_TTL = 14 * 24 * 60 * 60
+POLLER_CONCURRENCY = int(os.environ.get('PIPELINE_MGR_POLLER_CONCURRENCY', 8))
+
 
 def lambda_handler(event, context):
     """Determines course of action based on action property passed to it by
@@ -22,6 +49,18 @@ def lambda_handler(event, context):
 
     if action == 'HandleWebhook':
         return webhook_handler(event)
+    elif action == 'CheckSuperseded':
+        # After the debounce wait, only the execution for the latest push
+        # to the PR carries on
+        manager = Manager(event['manager'])
+        latest = StateStore().get(pr_key(manager.pull_request.number))
+        event['superseded'] = bool(
+            latest and latest['sha'] != manager.pull_request.sha)
+        if event['superseded']:
+            logger.info("{} of PR {} superseded by {}".format(
+                manager.pull_request.sha, manager.pull_request.number,
+                latest['sha']))
+        return event
     elif action == 'RetrieveSource':
         manager = Manager(event['manager'])
         manager.source.retrieve_source()
@@ -29,39 +68,305 @@ def lambda_handler(event, context):
         return event
     elif action == 'BuildPipeline':
         manager = Manager(event['manager'])
-        # Set from project root
-        template_path = 'pipeline/pipeline_deploy_stack.yaml'
-        manager.pipeline.build(manager.source,
-                               template_path)
+        # A pool stack only needs retargeting, so a PR is leased one unless
+        # it already has a stack, pooled or its own
+        pool = Pool()
+        pool_stack_name = pool.held_by(manager.pull_request.number)
+        if (pool.size and not pool_stack_name
+                and manager.pipeline.stack.status is None):
+            pool_stack_name = pool.claim(manager.pull_request.number)
+        if pool_stack_name:
+            manager.pipeline = Pipeline({
+                'name': pool_stack_name,
+                'app_stack_name': manager.pipeline.app_stack_name
+            })
+        event['stack_state'] = build_pipeline(manager, event)
+        event['manager'] = manager.to_dict()
+        return event
+    elif action == 'CheckStackStatus':
+        manager = Manager(event['manager'])
+        event['stack_state'] = manager.pipeline.stack.check()
+        if event.get('apply_pending') and event['stack_state'] != 'InProgress':
+            logger.info("Applying the template now stack {} is {}".format(
+                manager.pipeline.stack.name, manager.pipeline.stack.status))
+            event['stack_state'] = build_pipeline(manager, event)
         event['manager'] = manager.to_dict()
+        logger.info("Stack {} state {}".format(manager.pipeline.stack.name,
+                                               event['stack_state']))
         return event
+    elif action == 'RefillPool':
+        # Run on a schedule
+        return {'ready': Pool().refill()}
     elif action == 'StartTest':
         manager = Manager(event['manager'])
         execution_id = manager.pipeline.start()
-        manager.pull_request.set_status(manager.oath_token,
-                                        'pending',
-                                        manager.pipeline.name,
-                                        execution_id)
+        post_status(manager.pull_request, manager.oath_token, 'pending',
+                    manager.pipeline.name, execution_id)
+        # So pipeline_poller knows which PR a change of the pipeline is for
+        StateStore().put(pipeline_key(manager.pipeline.name),
+                         {'pull_request': manager.pull_request.to_dict()},
+                         ttl=PIPELINE_PR_TTL)
         event['manager'] = manager.to_dict()
         return event
+    elif action == 'AwaitTest':
+        # Invoked with a task token, the execution waits until
+        # complete_test() hands it back once the pipeline has finished
+        manager = Manager(event['manager'])
+        pipeline = manager.pipeline
+        StateStore().put(
+            execution_key(pipeline.name, pipeline.execution_id),
+            {'task_token': event['task_token'],
+             'manager': manager.to_dict()},
+            ttl=TASK_TOKEN_TTL
+        )
+        # The pipeline may have finished before the token was saved
+        status = pipeline.refresh_status()
+        if status in FINISHED_STATES.values():
+            complete_test(pipeline.name, pipeline.execution_id, status)
+        return
     elif action == 'CheckTestStatus':
-        # Simply rehydrating the manager object will update the pipeline status
+        # The status is passed on in the manager's dict to the TestStatus
+        # choice and SetTestStatus
         manager = Manager(event['manager'])
+        status = manager.pipeline.refresh_status()
         event['manager'] = manager.to_dict()
-        logger.info("Pipeline status {}".format(manager.pipeline.status))
+        logger.info("Pipeline status {}".format(status))
         return event
     elif action == 'SetTestStatus':
         manager = Manager(event['manager'])
-        if manager.pipeline.status == 'Succeeded':
-            pr_status = 'success'
-        elif manager.pipeline.status == 'Failed':
-            pr_status = 'failure'
-        else:
-            pr_status = 'error'
-        manager.pull_request.set_status(manager.oath_token,
-                                        pr_status,
-                                        manager.pipeline.name,
-                                        manager.pipeline.execution_id)
+        post_status(manager.pull_request, manager.oath_token,
+                    pr_status(manager.pipeline.status),
+                    manager.pipeline.name, manager.pipeline.execution_id)
+
+
+def build_pipeline(manager, event):
+    """Starts building the manager's pipeline, returns the state of its
+    stack. If an earlier operation on the stack is still in progress,
+    apply_pending is set on the event for CheckStackStatus to build once
+    it's done."""
+    # Set from project root
+    template_path = 'pipeline/pipeline_deploy_stack.yaml'
+    # The state machine polls with CheckStackStatus rather than keeping
+    # the function waiting on CloudFormation.
+    state = manager.pipeline.build(manager.source,
+                                   template_path,
+                                   wait=False)
+    event['apply_pending'] = state is None
+    return state or 'InProgress'
+
+
+def complete_test(pipeline_name, execution_id, status):
+    """Resumes the Step Functions execution waiting for a pipeline execution
+    with its final status. Returns False if nothing was waiting for it."""
+    waiting = StateStore().claim(execution_key(pipeline_name, execution_id))
+    if not waiting:
+        logger.info("Nothing waiting for {} execution {}".format(
+            pipeline_name, execution_id))
+        return False
+    manager_dict = waiting['manager']
+    manager_dict['pipeline']['status'] = status
+    output = {'pipeline_action': 'AwaitTest', 'manager': manager_dict}
+    try:
+        get_client('stepfunctions').send_task_success(
+            taskToken=waiting['task_token'],
+            output=json.dumps(output)
+        )
+    except ClientError as e:
+        # The execution timed out or was stopped in the meantime
+        if e.response['Error']['Code'] in ('InvalidToken',
+                                           'TaskDoesNotExist',
+                                           'TaskTimedOut'):
+            logger.warning("Execution waiting for {} execution {} has "
+                           "gone: {}".format(pipeline_name, execution_id, e))
+            return False
+        raise
+    logger.info("Completed test of {} execution {} as {}".format(
+        pipeline_name, execution_id, status))
+    return True
+
+
+def latest_execution(pipeline_name):
+    """Returns [execution id, status] of the latest execution of a pipeline,
+    or None if it has none or has been deleted."""
+    codepipeline = get_client('codepipeline')
+    try:
+        response = codepipeline.list_pipeline_executions(
+            pipelineName=pipeline_name, maxResults=1)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'PipelineNotFoundException':
+            return None
+        raise
+    summaries = response['pipelineExecutionSummaries']
+    if not summaries:
+        return None
+    return [summaries[0]['pipelineExecutionId'], summaries[0]['status']]
+
+
+def pipeline_event_handler(event, context):
+    """Handles CodePipeline Pipeline Execution State Change events, sent by
+    an Events rule, resuming the execution waiting for a test to finish.
+    """
+    detail = event['detail']
+    status = FINISHED_STATES.get(detail['state'])
+    if not status:
+        logger.info("Ignoring {} of {} execution {}".format(
+            detail['state'], detail['pipeline'], detail['execution-id']))
+        return
+    complete_test(detail['pipeline'], detail['execution-id'], status)
+
+
+def pipeline_poller(event, context):
+    """Run on a schedule, fetches the latest execution of every test
+    pipeline and acts only on those that changed since the last run. For
+    when an event from CodePipeline was missed.
+
+    A finished execution resumes the Step Functions execution waiting for
+    it, if any, otherwise its status is set on the PR directly.
+    """
+    codepipeline = get_client('codepipeline')
+    pipeline_names = []
+    for page in codepipeline.get_paginator('list_pipelines').paginate():
+        pipeline_names += [pipeline['name'] for pipeline in page['pipelines']
+                           if pipeline['name'].startswith(
+                               TEST_PIPELINE_PREFIX)]
+    with ThreadPoolExecutor(max_workers=POLLER_CONCURRENCY) as executor:
+        latest = dict(zip(pipeline_names,
+                          executor.map(latest_execution, pipeline_names)))
+    latest = {name: execution for name, execution in latest.items()
+              if execution}
+
+    store = StateStore()
+    known = store.get(POLLER_KEY)
+    first_run = known is None
+    if first_run:
+        # Nothing to compare with, so only finished executions that may
+        # still be waited for are acted on
+        known = {name: execution for name, execution in latest.items()
+                 if execution[1] not in FINISHED_STATES.values()}
+    changes = {name: execution for name, execution in latest.items()
+               if known.get(name) != execution}
+    logger.info("{} of {} test pipelines changed".format(len(changes),
+                                                         len(latest)))
+    for name, (execution_id, status) in sorted(changes.items()):
+        resumed = False
+        if status in FINISHED_STATES.values():
+            resumed = complete_test(name, execution_id, status)
+        # The status of an execution that was waited for is set by the
+        # state machine, and on the first run it may already have been set
+        if resumed or first_run:
+            continue
+        waiting_pr = store.get(pipeline_key(name))
+        if not waiting_pr:
+            logger.info("No PR known for {}".format(name))
+            continue
+        post_status(PullRequest(waiting_pr['pull_request']),
+                    os.environ['OAUTH_TOKEN'], pr_status(status), name,
+                    execution_id)
+    store.put(POLLER_KEY, latest)
+
+
+def post_status(pull_request, token, status, pipeline_name, execution_id):
+    """Sets the status of a pipeline execution on a PR, unless it's already
+    been set. The poller, StartTest and SetTestStatus can all see the same
+    status, only the first sets it. Returns False if it was already set.
+
+    The status is set under the name of the PR's own pipeline, whichever
+    pipeline ran the test, so a pool stack doesn't change the check's name.
+    """
+    store = StateStore()
+    item_id = status_key(pipeline_name, execution_id)
+    posted = store.put(item_id, {'status': status}, ttl=PIPELINE_PR_TTL)
+    if posted and posted['status'] == status:
+        logger.info("{} already set for {} execution {}".format(
+            status, pipeline_name, execution_id))
+        return False
+    context = TEST_PIPELINE_PREFIX + str(pull_request.number)
+    try:
+        pull_request.set_status(token, status, context, execution_id)
+    except Exception:
+        # Left for the next caller to set
+        store.claim(item_id)
+        raise
+    return True
+
+
+def pr_status(pipeline_status):
+    """Returns the PR status for the status of a pipeline execution"""
+    if pipeline_status == 'Succeeded':
+        return 'success'
+    elif pipeline_status == 'Failed':
+        return 'failure'
+    elif pipeline_status == 'InProgress':
+        return 'pending'
+    else:
+        return 'error'
+
+
+def stop_superseded(superseded, pr_number, sha):
+    """Stops the Step Functions execution started for a superseded push to
+    a PR, and the PR's test pipeline if it's still running."""
+    reason = "Superseded by {}".format(sha)
+    try:
+        get_client('stepfunctions').stop_execution(
+            executionArn=superseded['execution_arn'], cause=reason)
+        logger.info("Stopped {}".format(superseded['execution_arn']))
+    except ClientError as e:
+        logger.warning("Unable to stop {}: {}".format(
+            superseded['execution_arn'], e))
+
+    pipeline_name = (Pool().held_by(pr_number)
+                     or TEST_PIPELINE_PREFIX + str(pr_number))
+    execution = latest_execution(pipeline_name)
+    if execution and execution[1] == 'InProgress':
+        try:
+            get_client('codepipeline').stop_pipeline_execution(
+                pipelineName=pipeline_name,
+                pipelineExecutionId=execution[0],
+                abandon=True,
+                reason=reason
+            )
+            logger.info("Stopped {} execution {}".format(pipeline_name,
+                                                         execution[0]))
+        except ClientError as e:
+            logger.warning("Unable to stop {} execution {}: {}".format(
+                pipeline_name, execution[0], e))
+
+
+def webhook_receiver(event, context):
+    """Receives pull_request webhooks from the API GW. Irrelevant actions
+    are dropped, otherwise an execution of the state machine is started and
+    whatever was started for an earlier push to the PR is stopped. A closed
+    PR returns its pool stack, if it had one.
+
+    The PR's latest head SHA is saved, executions that are superseded
+    before the debounce wait ends stop themselves at CheckSuperseded.
+    """
+    webhook = event['body']
+    action = webhook.get('action')
+    if action not in RELEVANT_ACTIONS or 'pull_request' not in webhook:
+        logger.info("Ignoring {} webhook".format(action))
+        return {'status': 'ignored'}
+
+    pr_number = webhook['pull_request']['number']
+    sha = webhook['pull_request']['head']['sha']
+    execution_name = 'pr-{}-{}'.format(pr_number, event['request_id'])
+    response = get_client('stepfunctions').start_execution(
+        stateMachineArn=os.environ['STATE_MACHINE_ARN'],
+        name=execution_name,
+        input=json.dumps(webhook)
+    )
+    logger.info("Started {} for {} of PR {} at {}".format(
+        execution_name, action, pr_number, sha))
+    superseded = StateStore().put(
+        pr_key(pr_number),
+        {'sha': sha, 'execution_arn': response['executionArn']},
+        ttl=PR_TTL
+    )
+    if superseded:
+        stop_superseded(superseded, pr_number, sha)
+    if action == 'closed':
+        Pool().release(pr_number)
+    return {'status': 'started', 'execution': execution_name}
 
 
 def webhook_handler(event):
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Feeds recorded CodePipeline Pipeline Execution State Change events, like
+test_pipeline_event_succeeded.json, through pipeline_event_handler.
+
+With --task-token an execution waiting for each event's pipeline execution
+is saved first, as the AwaitTest action would, so the whole path through
+complete_test() is run. DynamoDB and Step Functions can be pointed at local
+stand-ins with AWS_ENDPOINT_URL_DYNAMODB and AWS_ENDPOINT_URL_STEPFUNCTIONS.
+"""
+import argparse
+import json
+import logging
+import os
+
+logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                    level=logging.INFO)
+
+parser = argparse.ArgumentParser(
+    description="Replays recorded CodePipeline events through the pipeline "
+                "manager's event handler.")
+parser.add_argument(
+    'events',
+    nargs='+',
+    help="Paths to recorded events"
+)
+parser.add_argument(
+    '--state-table',
+    default=os.environ.get('PIPELINE_MGR_STATE_TABLE'),
+    help="Name of the pipeline manager state table"
+)
+parser.add_argument(
+    '--task-token',
+    help="Saves a waiting execution with this task token for each event"
+)
+parser.add_argument(
+    '--webhook-path',
+    default="test_webhook.json",
+    help="Recorded webhook the waiting execution's manager is built from"
+)
+args = parser.parse_args()
+if not args.state_table:
+    parser.error("--state-table or PIPELINE_MGR_STATE_TABLE is required")
+os.environ['PIPELINE_MGR_STATE_TABLE'] = args.state_table
+
+# Imported once the environment is set up
+from pipeline_mgr.manager import Manager
+from pipeline_mgr.state_store import execution_key, StateStore
+import pipeline_mgr_lambdas
+
+
+def save_waiting_execution(event):
+    with open(args.webhook_path) as webhook_file:
+        webhook = json.load(webhook_file)
+    manager = Manager(
+        {
+            'bucket_name': 'replay',
+            'pull_request': webhook['pull_request'],
+            'oath_token': 'replay'
+        }
+    )
+    manager.pipeline.name = event['detail']['pipeline']
+    manager.pipeline.execution_id = event['detail']['execution-id']
+    StateStore().put(
+        execution_key(manager.pipeline.name, manager.pipeline.execution_id),
+        {'task_token': args.task_token, 'manager': manager.to_dict()},
+        ttl=pipeline_mgr_lambdas.TASK_TOKEN_TTL
+    )
+
+
+for event_path in args.events:
+    with open(event_path) as event_file:
+        event = json.load(event_file)
+    logging.info("Replaying {} ({})".format(event_path,
+                                            event['detail']['state']))
+    if args.task_token:
+        save_waiting_execution(event)
+    pipeline_mgr_lambdas.pipeline_event_handler(event, None)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import io
+import sys
+import zlib
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+import pytest
+
+from pipeline_mgr.archive import *
+
+# repackage() relies on zipfile as of 3.6, the pipeline manager's Lambda
+# runtime, which the unit test build image predates
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 6),
+                                reason="needs Python 3.6 zipfile")
+
+ROOT = 'nimbusscale-TheBestest-abc1234/'
+FILES = {
+    'README.md': b'# TheBestest\n' * 100,
+    'functions/get_items/get_items.py': b'import boto3\n' * 500,
+    'pipeline/empty.txt': b'',
+    'static/logo.png': bytes(range(256)) * 40
+}
+
+
+def github_zipball(root=ROOT, date_time=(2018, 3, 1, 12, 0, 0),
+                   reverse=False):
+    """Returns a zipball laid out like GitHub's, everything in one root dir
+    with entries for the dirs."""
+    zipball = io.BytesIO()
+    with ZipFile(zipball, mode='w') as src_zip:
+        src_zip.writestr(root, b'')
+        for name, data in sorted(FILES.items(), reverse=reverse):
+            zinfo = ZipInfo(root + name, date_time=date_time)
+            zinfo.compress_type = (ZIP_STORED if name.endswith('.png')
+                                   else ZIP_DEFLATED)
+            zinfo.create_system = CREATE_SYSTEM_UNIX
+            mode = EXECUTABLE_MODE if name.endswith('.py') else FILE_MODE
+            zinfo.external_attr = mode << 16
+            src_zip.writestr(zinfo, data)
+    zipball.seek(0)
+    return zipball
+
+
+class UnseekableWriter(io.RawIOBase):
+    """Write only file object that can't seek, like an upload"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def test_repackage():
+    dest = io.BytesIO()
+    repackage(github_zipball(), dest)
+    with ZipFile(dest) as dest_zip:
+        assert dest_zip.testzip() is None
+        assert sorted(dest_zip.namelist()) == sorted(FILES)
+        for name, data in FILES.items():
+            assert dest_zip.read(name) == data
+
+
+def test_repackage_same_tree_same_bytes():
+    # Another commit of the same tree, stamped with a later time and listed
+    # in another order
+    first = io.BytesIO()
+    repackage(github_zipball(), first)
+    second = io.BytesIO()
+    repackage(github_zipball('nimbusscale-TheBestest-def5678/',
+                             (2018, 4, 2, 9, 30, 0), reverse=True),
+              second)
+    assert first.getvalue() == second.getvalue()
+    with ZipFile(first) as dest_zip:
+        assert dest_zip.namelist() == sorted(FILES)
+        for info in dest_zip.infolist():
+            assert info.date_time == FIXED_DATE_TIME
+        script = dest_zip.getinfo('functions/get_items/get_items.py')
+        assert script.external_attr >> 16 == EXECUTABLE_MODE
+        assert dest_zip.getinfo('README.md').external_attr >> 16 == FILE_MODE
+
+
+def test_repackage_unseekable():
+    dest = UnseekableWriter()
+    repackage(github_zipball(), dest)
+    with ZipFile(io.BytesIO(bytes(dest.data))) as dest_zip:
+        assert dest_zip.testzip() is None
+        assert dest_zip.read('README.md') == FILES['README.md']
+
+
+def test_repackage_strip_prefix():
+    dest = io.BytesIO()
+    repackage(github_zipball(), dest, strip_prefix=ROOT + 'functions/')
+    with ZipFile(dest) as dest_zip:
+        assert dest_zip.testzip() is None
+        assert dest_zip.namelist() == ['get_items/get_items.py']
+
+
+def test_root_dir():
+    with ZipFile(github_zipball()) as src_zip:
+        assert root_dir(src_zip.infolist()) == ROOT
+    flat = io.BytesIO()
+    with ZipFile(flat, mode='w') as flat_zip:
+        flat_zip.writestr('README.md', FILES['README.md'])
+    with ZipFile(flat) as flat_zip:
+        assert root_dir(flat_zip.infolist()) == ''
+
+
+def test_write_raw_member():
+    data = b'central bbq\n' * 1000
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    zinfo = ZipInfo('places.txt')
+    zinfo.compress_type = ZIP_DEFLATED
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed)
+    dest = io.BytesIO()
+    with ZipFile(dest, mode='w') as dest_zip:
+        # Handed over in chunks, as iter_raw_data() does
+        write_raw_member(dest_zip, zinfo,
+                         [compressed[:10], compressed[10:]])
+        dest_zip.writestr('after.txt', b'written by zipfile')
+    with ZipFile(dest) as dest_zip:
+        assert dest_zip.testzip() is None
+        assert dest_zip.read('places.txt') == data
+        assert dest_zip.read('after.txt') == b'written by zipfile'
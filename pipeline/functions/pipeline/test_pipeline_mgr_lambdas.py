@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import pytest
+
+import pipeline_mgr_lambdas
+from pipeline_mgr_lambdas import *
+
+PR = {'number': 7, 'head': {'ref': 'feature', 'sha': 'abc1234'}}
+
+
+class StubStateStore:
+    """Stands in for StateStore, items are kept in memory and shared by all
+    instances, as they would be in the table"""
+    items = {}
+
+    def claim(self, item_id):
+        return self.items.pop(item_id, None)
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def put(self, item_id, state, ttl=None):
+        replaced = self.items.get(item_id)
+        self.items[item_id] = state
+        return replaced
+
+
+class StubCodePipeline:
+    """Stands in for the CodePipeline client, listing pipelines over two
+    pages"""
+
+    def __init__(self, names):
+        self.names = names
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self):
+        return [{'pipelines': [{'name': name} for name in self.names[:1]]},
+                {'pipelines': [{'name': name} for name in self.names[1:]]}]
+
+
+class Poller:
+    """What pipeline_poller sees and does. executions are the latest
+    execution of each pipeline, waiting those complete_test resumes."""
+
+    def __init__(self):
+        self.executions = {}
+        self.waiting = set()
+        self.completed = []
+        self.statuses = []
+        self.store = StubStateStore()
+
+
+@pytest.fixture
+def poller(monkeypatch):
+    """Stubs everything pipeline_poller and post_status call"""
+    stub = Poller()
+
+    def complete_test(name, execution_id, status):
+        stub.completed.append((name, execution_id, status))
+        return (name, execution_id) in stub.waiting
+
+    def set_status(pull_request, token, status, context, description):
+        stub.statuses.append((pull_request.number, status, context,
+                              description))
+
+    monkeypatch.setenv('OAUTH_TOKEN', 'token')
+    monkeypatch.setattr(StubStateStore, 'items', {})
+    monkeypatch.setattr(pipeline_mgr_lambdas, 'StateStore', StubStateStore)
+    monkeypatch.setattr(
+        pipeline_mgr_lambdas, 'get_client',
+        lambda service_name: StubCodePipeline(sorted(stub.executions)))
+    monkeypatch.setattr(pipeline_mgr_lambdas, 'latest_execution',
+                        lambda name: stub.executions[name])
+    monkeypatch.setattr(pipeline_mgr_lambdas, 'complete_test', complete_test)
+    monkeypatch.setattr(PullRequest, 'set_status', set_status)
+    return stub
+
+
+def test_pipeline_poller_first_run(poller):
+    poller.executions = {'thebestest-pipeline-test-1': ['e1', 'Succeeded'],
+                         'thebestest-pipeline-test-2': ['e2', 'InProgress'],
+                         'thebestest-pipeline-test-3': None,
+                         'thebestest-pipeline': ['e4', 'Failed']}
+    poller.store.put(pipeline_key('thebestest-pipeline-test-1'),
+                     {'pull_request': PR})
+    pipeline_poller({}, None)
+    # Finished executions may still be waited for, but no status is set as
+    # it isn't known whether it already was
+    assert poller.completed == [
+        ('thebestest-pipeline-test-1', 'e1', 'Succeeded')]
+    assert poller.statuses == []
+    assert poller.store.get(POLLER_KEY) == {
+        'thebestest-pipeline-test-1': ['e1', 'Succeeded'],
+        'thebestest-pipeline-test-2': ['e2', 'InProgress']}
+
+
+def test_pipeline_poller_changes(poller):
+    poller.store.put(POLLER_KEY, {
+        'thebestest-pipeline-test-1': ['e1', 'InProgress'],
+        'thebestest-pipeline-test-2': ['e2', 'InProgress'],
+        'thebestest-pipeline-test-3': ['e3', 'InProgress']})
+    poller.executions = {'thebestest-pipeline-test-1': ['e1', 'Failed'],
+                         'thebestest-pipeline-test-2': ['e2', 'InProgress'],
+                         'thebestest-pipeline-test-3': ['e5', 'Succeeded'],
+                         'thebestest-pipeline-test-4': ['e6', 'InProgress']}
+    for number in (1, 3, 4):
+        poller.store.put(
+            pipeline_key('thebestest-pipeline-test-{}'.format(number)),
+            {'pull_request': dict(PR, number=number)})
+    # The state machine is waiting for e5, it sets the status itself
+    poller.waiting.add(('thebestest-pipeline-test-3', 'e5'))
+    pipeline_poller({}, None)
+    assert poller.completed == [
+        ('thebestest-pipeline-test-1', 'e1', 'Failed'),
+        ('thebestest-pipeline-test-3', 'e5', 'Succeeded')]
+    assert poller.statuses == [
+        (1, 'failure', 'thebestest-pipeline-test-1', 'e1'),
+        (4, 'pending', 'thebestest-pipeline-test-4', 'e6')]
+    assert poller.store.get(POLLER_KEY) == poller.executions
+
+    # Nothing changed since
+    pipeline_poller({}, None)
+    assert len(poller.completed) == 2
+    assert len(poller.statuses) == 2
+
+
+def test_pipeline_poller_unknown_pr(poller):
+    poller.store.put(POLLER_KEY, {})
+    poller.executions = {'thebestest-pipeline-test-1': ['e1', 'Failed']}
+    pipeline_poller({}, None)
+    assert poller.completed == [
+        ('thebestest-pipeline-test-1', 'e1', 'Failed')]
+    assert poller.statuses == []
+
+
+def test_post_status_dedupe(poller):
+    pull_request = PullRequest(PR)
+    assert post_status(pull_request, 'token', 'pending',
+                       'thebestest-pipeline-test-7', 'e1')
+    assert not post_status(pull_request, 'token', 'pending',
+                           'thebestest-pipeline-test-7', 'e1')
+    assert post_status(pull_request, 'token', 'success',
+                       'thebestest-pipeline-test-7', 'e1')
+    assert poller.statuses == [
+        (7, 'pending', 'thebestest-pipeline-test-7', 'e1'),
+        (7, 'success', 'thebestest-pipeline-test-7', 'e1')]
+
+
+def test_post_status_pool_stack(poller):
+    # The check keeps the PR's name whichever pool stack ran the test
+    assert post_status(PullRequest(PR), 'token', 'pending',
+                       'thebestest-pipeline-test-pool-1', 'e1')
+    assert poller.statuses == [
+        (7, 'pending', 'thebestest-pipeline-test-7', 'e1')]
+
+
+def test_post_status_failed(poller, monkeypatch):
+    def set_status(pull_request, token, status, context, description):
+        raise RuntimeError("GitHub is down")
+
+    monkeypatch.setattr(PullRequest, 'set_status', set_status)
+    with pytest.raises(RuntimeError):
+        post_status(PullRequest(PR), 'token', 'success',
+                    'thebestest-pipeline-test-7', 'e1')
+    # Left for the next caller to set
+    assert poller.store.get(
+        status_key('thebestest-pipeline-test-7', 'e1')) is None
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import json
+import time
+
+import pytest
+
+from pipeline_mgr import state_store
+from pipeline_mgr.state_store import *
+
+
+class StubDynamoDB:
+    """Stands in for the DynamoDB client, holding items as given. Like
+    DynamoDB, expired items are kept until they're removed."""
+
+    def __init__(self):
+        self.items = {}
+
+    def delete_item(self, TableName, Key, ReturnValues):
+        item = self.items.pop(Key['id']['S'], None)
+        return {'Attributes': item} if item else {}
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key['id']['S'])
+        return {'Item': item} if item else {}
+
+    def put_item(self, TableName, Item, ReturnValues):
+        old_item = self.items.get(Item['id']['S'])
+        self.items[Item['id']['S']] = Item
+        return {'Attributes': old_item} if old_item else {}
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    stub = StubDynamoDB()
+    monkeypatch.setattr(state_store, 'get_client', lambda service_name: stub)
+    return stub
+
+
+def test_state_store(dynamodb):
+    store = StateStore('state')
+    assert store.get('pr:7') is None
+    assert store.put('pr:7', {'sha': 'abc1234'}, ttl=60) is None
+    assert store.get('pr:7') == {'sha': 'abc1234'}
+    assert store.put('pr:7', {'sha': 'def5678'}) == {'sha': 'abc1234'}
+    assert store.claim('pr:7') == {'sha': 'def5678'}
+    assert store.claim('pr:7') is None
+
+
+def test_state_store_expired(dynamodb):
+    store = StateStore('state')
+    dynamodb.items['pool-pr:7'] = {
+        'id': {'S': 'pool-pr:7'},
+        'state': {'S': json.dumps({'stack_name': 'pool-1'})},
+        'expires': {'N': str(int(time.time()) - 1)}
+    }
+    assert store.get('pool-pr:7') is None
+    assert store.put('pool-pr:7', {'stack_name': 'pool-2'}) is None
+    dynamodb.items['pool-pr:7']['expires'] = {'N': '0'}
+    assert store.claim('pool-pr:7') is None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import hashlib
+import threading
+import time
+
+import pytest
+
+from pipeline_mgr import transfer
+from pipeline_mgr.transfer import *
+
+
+class StubS3:
+    """Stands in for the S3 client, parts finish in reverse order"""
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.aborted = False
+        self.completed = None
+        self.parts = {}
+        self._lock = threading.Lock()
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self.completed = MultipartUpload['Parts']
+        return {'VersionId': 'v1'}
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        time.sleep(0.05 / PartNumber)
+        if PartNumber == self.fail_part:
+            raise RuntimeError("part {} failed".format(PartNumber))
+        with self._lock:
+            self.parts[PartNumber] = Body
+        return {'ETag': 'etag-{}'.format(PartNumber)}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3()
+    monkeypatch.setattr(transfer, 'get_client', lambda service_name: stub)
+    return stub
+
+
+def test_multipart_upload_writer(s3):
+    data = bytes(range(256)) * 100
+    with MultipartUploadWriter('bucket', 'key', part_size=1000,
+                               max_concurrency=4) as upload:
+        for i in range(0, len(data), 300):
+            upload.write(data[i:i + 300])
+    assert [part['PartNumber'] for part in s3.completed] == list(
+        range(1, 27))
+    assert [part['ETag'] for part in s3.completed] == [
+        'etag-{}'.format(number) for number in range(1, 27)]
+    assert b''.join(s3.parts[number] for number in range(1, 27)) == data
+    assert upload.version_id == 'v1'
+    assert upload.tell() == len(data)
+    assert upload.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert not s3.aborted
+
+
+def test_multipart_upload_writer_empty(s3):
+    with MultipartUploadWriter('bucket', 'key') as upload:
+        pass
+    assert s3.parts == {1: b''}
+    assert len(s3.completed) == 1
+    assert upload.version_id == 'v1'
+    assert upload.tell() == 0
+
+
+def test_multipart_upload_writer_failed_part(s3):
+    s3.fail_part = 2
+    with pytest.raises(RuntimeError):
+        with MultipartUploadWriter('bucket', 'key', part_size=1000) as upload:
+            upload.write(b'x' * 3500)
+    assert s3.aborted
+    assert s3.completed is None
+
+
+def test_multipart_upload_writer_error_while_writing(s3):
+    with pytest.raises(ValueError):
+        with MultipartUploadWriter('bucket', 'key', part_size=1000) as upload:
+            upload.write(b'x' * 1500)
+            raise ValueError("repackaging failed")
+    assert s3.aborted
+    assert s3.completed is None
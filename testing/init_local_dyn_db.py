@@ -53,6 +53,61 @@ def get_dynamodb_table_specs():
                 'ReadCapacityUnits': 5,
                 'WriteCapacityUnits': 5
             }
+        },
+        'CategoryCountTable': {
+            'TableName': 'thebestest_unittest_category_counts',
+            'KeySchema': [
+                {'AttributeName': 'category_name', 'KeyType': 'HASH'},
+                {'AttributeName': 'place_name', 'KeyType': 'RANGE'}
+            ],
+            'AttributeDefinitions': [
+                {'AttributeName': 'category_name', 'AttributeType': 'S'},
+                {'AttributeName': 'place_name', 'AttributeType': 'S'},
+                {'AttributeName': 'save_count', 'AttributeType': 'N'}
+            ],
+            'LocalSecondaryIndexes': [
+                {
+                    'IndexName': 'ByCount',
+                    'KeySchema': [
+                        {'AttributeName': 'category_name',
+                         'KeyType': 'HASH'},
+                        {'AttributeName': 'save_count', 'KeyType': 'RANGE'}
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'}
+                }
+            ],
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        },
+        'AppliedSequenceTable': {
+            'TableName': 'thebestest_unittest_applied_sequences',
+            'KeySchema': [
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'category_name', 'KeyType': 'RANGE'}
+            ],
+            'AttributeDefinitions': [
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': 'category_name', 'AttributeType': 'S'}
+            ],
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        },
+        'ItemVersionTable': {
+            'TableName': 'thebestest_unittest_item_versions',
+            'KeySchema': [
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'}
+            ],
+            'AttributeDefinitions': [
+                {'AttributeName': 'user_id', 'AttributeType': 'S'}
+            ],
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
         }
     }
 
@@ -74,7 +129,14 @@ def seed_items_table(table_name):
     items = [
         {'user_id': "jjk3", 'category_name': "bbq",
          'place_name': "central bbq"},
-        {'user_id': "jdebari", 'category_name': "bbq", 'place_name': "AJs"}
+        {'user_id': "jdebari", 'category_name': "bbq", 'place_name': "AJs"},
+        # pager has enough items to span several pages
+        {'user_id': "pager", 'category_name': "bbq",
+         'place_name': "central bbq"},
+        {'user_id': "pager", 'category_name': "pizza",
+         'place_name': "aldos"},
+        {'user_id': "pager", 'category_name': "tacos",
+         'place_name': "las delicias"}
     ]
     for item in items:
         table.put_item(Item=item)